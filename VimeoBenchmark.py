@@ -0,0 +1,484 @@
+#!/usr/bin/python
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from getopt import getopt
+from json import dump as jsonDump, dumps as jsonDumps
+from os import remove
+from os.path import basename, isfile, join
+from re import compile as reCompile
+from shutil import rmtree
+from SocketServer import ThreadingMixIn
+from sys import argv, exit as sysExit, stdout
+from tempfile import mkdtemp
+from threading import BoundedSemaphore, Lock, Thread
+from time import time
+from urlparse import urlparse, parse_qs
+from zlib import crc32
+
+import VimeoCrawler
+from VimeoCrawler import CurlTransport, DownloadJob, HTTPListing, PageCache, Reactor, ReactorListing, REACTOR_LIMITS, VimeoAPI, WorkerPool, createSession, getFileSize, parseSize, requests
+
+TITLE = 'VimeoBenchmark (c) 2013-2016 Vasily Zakharov vmzakhar@gmail.com'
+
+USAGE_INFO = '''Usage: python VimeoBenchmark.py [options]
+
+Starts a local HTTP server imitating Vimeo account, channel, album and video pages,
+the Vimeo API resources for them, and downloadable video files, runs VimeoCrawler against it and reports the results as JSON.
+
+Measured are listing pages per second of getItemsFromURL() with the http backend
+on both engines, with all the pages revalidated in the page cache, with the api backend reading the mock API, and with the browser, latency of processVideo() per video in the browser,
+and download speed in MB/s with a single stream, with segmented downloads
+and with all the files downloaded at once by the reactor engine.
+
+Options:
+-h --help - Displays this help message.
+   --videos - Number of videos in the mock account, default is 200.
+   --folders - Number of channels and of albums in the mock account, default is 4.
+   --page-size - Number of videos on a listing page, default is 12.
+   --process - Number of videos to measure processVideo() latency on, default is 10.
+   --downloads - Number of files to download in each download mode, default is 3.
+   --file-size - Size of the downloadable files, K, M and G suffixes are allowed, default is 64M.
+   --segments - Number of connections for segmented downloads, default is 4.
+   --webdriver - Selenium WebDriver to use for the browser benchmarks, default is Firefox.
+   --no-browser - Skip the benchmarks that require a browser.
+   --port - Port for the mock server to listen at, default is any free port.
+   --output - File to write the JSON results to, default is the standard output.
+   --keep - Keep the temporary target directory with the downloaded files and logs.
+'''
+
+ACCOUNT = 'benchmark'
+FIRST_VID = 100000000
+JPEG = '\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xd9' # Minimal JPEG-like file with proper magic numbers
+BLOCK = ''.join(chr(i) for i in xrange(256)) * 256 # 64 kilobytes of file content pattern
+RANGE_PATTERN = reCompile(r'bytes=(\d*)-(\d*)$')
+LAST_MODIFIED = 'Mon, 01 Feb 2016 00:00:00 GMT'
+
+LISTING_PAGE = '''<html><head><title>%(title)s</title></head><body>
+<div id="topnav_desktop"><a href="/vimeo.com/%(account)s">%(account)s</a></div>
+<div id="%(header)s">%(headerHTML)s</div>
+<div id="browse_content"><ol>
+%(items)s
+</ol></div>
+<div class="pagination">%(next)s</div>
+</body></html>'''
+
+VIDEO_PAGE = '''<html><head><title>Video %(vID)d</title></head><body>
+<div id="topnav_desktop"><a href="/vimeo.com/%(account)s">%(account)s</a></div>
+<h1 class="clip_info-header"><span>Benchmark video %(vID)d</span></h1>
+<a class="js-user_link" href="/vimeo.com/%(account)s">%(account)s</a>
+<div class="video-wrapper"><div class="video" style="width: 640px; height: 360px; background-image: url(&quot;%(base)s/files/%(vID)d.jpg&quot;)"></div></div>
+<div class="clip_details"><div class="iris_desc-content"><p>Description of benchmark video %(vID)d.</p></div></div>
+<button onclick="document.getElementById('download_panel').style.display = 'block'"><span>Download</span></button>
+<div id="download_panel" tabindex="0" style="display: none"><table>
+<tr><td>SD</td><td><a download="benchmark-sd.mp4" href="%(base)s/files/%(vID)d.mp4">Download</a></td></tr>
+<tr><td>1080p</td><td><a download="benchmark-1080p.mp4" href="%(base)s/files/%(vID)d.mp4">Download</a></td></tr>
+</table></div>
+</body></html>'''
+
+def usage(error = None):
+    '''Prints usage information (preceded by optional error message) and exits with code 2 (or 0 if no error message is provided).'''
+    print "%s\n" % TITLE
+    print USAGE_INFO
+    if error:
+        print error
+    sysExit(2 if error else 0)
+
+class MockVimeo(object):
+    '''Synthetic Vimeo account with videos, channels and albums, rendered to pages using the selectors VimeoCrawler relies on.'''
+    def __init__(self, numVideos, numFolders, pageSize, fileSize):
+        self.vIDs = tuple(xrange(FIRST_VID + numVideos - 1, FIRST_VID - 1, -1)) # Newest first, as Vimeo lists them
+        self.pageSize = pageSize
+        self.fileSize = fileSize
+        self.channels = dict(('%s-channel-%d' % (ACCOUNT, i), self.vIDs[i::numFolders]) for i in xrange(1, numFolders + 1))
+        self.albums = dict((str(1000 + i), self.vIDs[: pageSize * i + 1]) for i in xrange(1, numFolders + 1))
+        self.lock = Lock()
+        self.counts = {}
+
+    def count(self, kind, amount = 1):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + amount
+
+    def get(self, kind):
+        with self.lock:
+            return self.counts.get(kind, 0)
+
+    def listing(self, path, page, title, links, header = 'page_header', headerHTML = None):
+        start = (page - 1) * self.pageSize
+        nextLink = ('<a rel="next" href="/vimeo.com%s?page=%d">Next</a>' % (path, page + 1)) if start + self.pageSize < len(links) else ''
+        return LISTING_PAGE % {'account': ACCOUNT, 'title': title, 'header': header, 'headerHTML': headerHTML or '<h1>%s</h1>' % title, 'next': nextLink,
+                               'items': '\n'.join('<li class="browse"><a href="/vimeo.com/%s">%s</a></li>' % (link, link) for link in links[start : start + self.pageSize])}
+
+    def page(self, path, page, base):
+        '''Returns HTML of the page at the specified path under /vimeo.com, or None if there's no such page.'''
+        tokens = path.strip('/').split('/')
+        if len(tokens) == 1 and tokens[0].isdigit() and int(tokens[0]) in self.vIDs:
+            self.count('video')
+            return VIDEO_PAGE % {'account': ACCOUNT, 'vID': int(tokens[0]), 'base': base}
+        html = None
+        if tokens == [ACCOUNT, 'videos']:
+            html = self.listing(path, page, "%s videos" % ACCOUNT, self.vIDs)
+        elif tokens == [ACCOUNT, 'channels']:
+            html = self.listing(path, page, "%s channels" % ACCOUNT, tuple('channels/%s' % name for name in sorted(self.channels)))
+        elif tokens == [ACCOUNT, 'albums']:
+            html = self.listing(path, page, "%s albums" % ACCOUNT, tuple('album/%s' % name for name in sorted(self.albums)))
+        elif len(tokens) == 3 and tokens[0] == 'channels' and tokens[2] == 'videos' and tokens[1] in self.channels:
+            html = self.listing(path, page, tokens[1], self.channels[tokens[1]], headerHTML = '<h1><a href="/vimeo.com/channels/%s">%s</a></h1>' % (tokens[1], tokens[1]))
+        elif len(tokens) == 2 and tokens[0] == 'album' and tokens[1] in self.albums:
+            html = self.listing(path, page, 'Album %s' % tokens[1], self.albums[tokens[1]])
+        if html:
+            self.count('listing')
+        return html
+
+    def collection(self, path, page, perPage, resources):
+        start = (page - 1) * perPage
+        self.count('listing')
+        return {'total': len(resources), 'page': page, 'per_page': perPage, 'data': resources[start : start + perPage],
+                'paging': {'next': ('%s?page=%d&per_page=%d' % (path, page + 1, perPage)) if start + perPage < len(resources) else None}}
+
+    def video(self, vID, base):
+        link = '%s/files/%d.mp4' % (base, vID)
+        return {'uri': '/videos/%d' % vID, 'name': 'Benchmark video %d' % vID, 'link': '%s/vimeo.com/%d' % (base, vID),
+                'description': 'Description of benchmark video %d.' % vID, 'user': {'name': ACCOUNT}, 'privacy': {'view': 'anybody'},
+                'pictures': {'sizes': [{'width': 640, 'height': 360, 'link': '%s/files/%d.jpg' % (base, vID)}]},
+                'download': [{'quality': quality, 'rendition': rendition, 'link': link, 'size': self.fileSize, 'expires': '2100-01-01T00:00:00+00:00'}
+                             for (quality, rendition) in (('sd', '540p'), ('hd', '1080p'))]}
+
+    @staticmethod
+    def channel(name, base):
+        return {'uri': '/channels/%s' % name, 'name': name, 'link': '%s/vimeo.com/channels/%s' % (base, name),
+                'metadata': {'connections': {'videos': {'uri': '/channels/%s/videos' % name}}}}
+
+    @staticmethod
+    def album(name, base):
+        uri = '/users/%s/albums/%s' % (ACCOUNT, name)
+        return {'uri': uri, 'name': 'Album %s' % name, 'link': '%s/vimeo.com/album/%s' % (base, name),
+                'metadata': {'connections': {'videos': {'uri': uri + '/videos'}}}}
+
+    def api(self, path, page, perPage, base):
+        '''Returns the API resource at the specified path under /api, or None if there's no such resource.'''
+        tokens = path.strip('/').split('/')
+        if tokens == ['me']:
+            return {'name': ACCOUNT, 'link': '%s/vimeo.com/%s' % (base, ACCOUNT)}
+        if len(tokens) == 2 and tokens[0] == 'videos' and tokens[1].isdigit() and int(tokens[1]) in self.vIDs:
+            self.count('video')
+            return self.video(int(tokens[1]), base)
+        if tokens == ['users', ACCOUNT, 'videos']:
+            return self.collection(path, page, perPage, [self.video(vID, base) for vID in self.vIDs])
+        if tokens == ['users', ACCOUNT, 'channels']:
+            return self.collection(path, page, perPage, [self.channel(name, base) for name in sorted(self.channels)])
+        if tokens == ['users', ACCOUNT, 'albums']:
+            return self.collection(path, page, perPage, [self.album(name, base) for name in sorted(self.albums)])
+        # The folders are only found at the paths the listings and the lookups return, not at the paths a client might build
+        if len(tokens) == 2 and tokens[0] == 'channels' and tokens[1] in self.channels:
+            return self.channel(tokens[1], base)
+        if len(tokens) == 3 and tokens[:2] == ['me', 'albums'] and tokens[2] in self.albums:
+            return self.album(tokens[2], base)
+        if len(tokens) == 3 and tokens[0] == 'channels' and tokens[1] in self.channels and tokens[2] == 'videos':
+            return self.collection(path, page, perPage, [self.video(vID, base) for vID in self.channels[tokens[1]]])
+        if len(tokens) == 5 and tokens[:3] == ['users', ACCOUNT, 'albums'] and tokens[3] in self.albums and tokens[4] == 'videos':
+            return self.collection(path, page, perPage, [self.video(vID, base) for vID in self.albums[tokens[3]]])
+        return None
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, as pooled sessions expect
+    disable_nagle_algorithm = True
+    wbufsize = -1 # Headers and small bodies are sent at once, the buffer is flushed after every request
+
+    def log_message(self, *_args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def reply(self, code, headers, body = ''):
+        self.send_response(code)
+        for header in sorted(headers.iteritems()):
+            self.send_header(*header)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return body
+
+    def serve(self, withBody):
+        mock = self.server.mock
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page = int((query.get('page') or ('1',))[0])
+        body = None
+        if url.path.startswith('/files/'):
+            fileName = basename(url.path)
+            if fileName.endswith('.jpg'):
+                etag = '"%s"' % fileName
+                if self.headers.get('If-None-Match') == etag:
+                    body = self.reply(304, {'ETag': etag})
+                else:
+                    mock.count('thumbnail')
+                    body = self.reply(200, {'Content-Type': 'image/jpeg', 'ETag': etag}, JPEG)
+            elif fileName.endswith('.mp4'):
+                return self.serveFile(mock, fileName, withBody)
+        elif url.path.startswith('/api/'):
+            resource = mock.api(url.path[len('/api'):], page, int((query.get('per_page') or ('25',))[0]), 'http://%s:%d' % self.server.server_address)
+            if resource is not None:
+                body = self.reply(200, {'Content-Type': 'application/vnd.vimeo.video+json'}, jsonDumps(resource))
+        elif url.path.startswith('/vimeo.com/'):
+            html = mock.page(url.path[len('/vimeo.com'):], page, 'http://%s:%d' % self.server.server_address)
+            if html:
+                etag = '"%08x"' % (crc32(html) & 0xffffffff)
+                if self.headers.get('If-None-Match') == etag:
+                    body = self.reply(304, {'ETag': etag})
+                else:
+                    body = self.reply(200, {'Content-Type': 'text/html; charset=utf-8', 'ETag': etag}, html)
+        if body is None:
+            body = self.reply(404, {'Content-Type': 'text/plain'}, 'Not found')
+        if withBody:
+            self.wfile.write(body)
+
+    def serveFile(self, mock, fileName, withBody):
+        size = mock.fileSize
+        headers = {'Content-Type': 'video/mp4', 'Accept-Ranges': 'bytes', 'ETag': '"%s-%d"' % (fileName, size), 'Last-Modified': LAST_MODIFIED}
+        (start, end) = (0, size - 1)
+        m = RANGE_PATTERN.match(self.headers.get('Range') or '')
+        if m:
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            elif m.group(2):
+                start = max(0, size - int(m.group(2)))
+            if start >= size or start > end:
+                headers['Content-Range'] = 'bytes */%d' % size
+                self.reply(416, headers)
+                return
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        headers['Content-Length'] = str(end - start + 1)
+        self.reply(206 if m else 200, headers)
+        if not withBody:
+            return
+        mock.count('file')
+        position = start
+        while position <= end:
+            offset = position % len(BLOCK)
+            length = min(len(BLOCK) - offset, end + 1 - position)
+            self.wfile.write(BLOCK[offset : offset + length])
+            position += length
+        mock.count('bytes', end - start + 1)
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, mock):
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.mock = mock
+        self.baseURL = 'http://%s:%d/vimeo.com' % self.server_address
+
+    def start(self):
+        thread = Thread(target = self.serve_forever, name = 'MockServer')
+        thread.daemon = True
+        thread.start()
+
+def statistics(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {'count': len(values), 'min': values[0], 'max': values[-1], 'mean': sum(values) / len(values),
+            'median': values[len(values) // 2], 'p90': values[min(len(values) - 1, int(len(values) * 0.9))]}
+
+class VimeoBenchmark(object):
+    def __init__(self, args):
+        self.numVideos = 200
+        self.numFolders = 4
+        self.pageSize = 12
+        self.numProcess = 10
+        self.numDownloads = 3
+        self.fileSize = '64M'
+        self.segments = 4
+        self.driverName = 'Firefox'
+        self.useBrowser = True
+        self.port = 0
+        self.outputFileName = None
+        self.keep = False
+        try:
+            (options, parameters) = getopt(args, 'h', ('help', 'videos=', 'folders=', 'page-size=', 'process=', 'downloads=', 'file-size=', 'segments=', 'webdriver=', 'no-browser', 'port=', 'output=', 'keep'))
+            if parameters:
+                raise ValueError("Unexpected parameters: %s" % ' '.join(parameters))
+            for (option, value) in options:
+                if option in ('-h', '--help'):
+                    usage()
+                elif option == '--no-browser':
+                    self.useBrowser = False
+                elif option == '--keep':
+                    self.keep = True
+                elif option == '--webdriver':
+                    self.driverName = value
+                elif option == '--output':
+                    self.outputFileName = value
+                elif option == '--file-size':
+                    self.fileSize = value
+                else:
+                    field = {'--videos': 'numVideos', '--folders': 'numFolders', '--page-size': 'pageSize', '--process': 'numProcess',
+                             '--downloads': 'numDownloads', '--segments': 'segments', '--port': 'port'}[option]
+                    try:
+                        setattr(self, field, int(value))
+                        if getattr(self, field) < (0 if option in ('--port', '--process', '--downloads') else 1):
+                            raise ValueError
+                    except ValueError:
+                        raise ValueError("%s parameter must be a %s integer" % (option, 'non-negative' if option in ('--port', '--process', '--downloads') else 'positive'))
+            try:
+                self.fileSize = parseSize(self.fileSize)
+                if self.fileSize < 1:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("--file-size parameter must be a positive size, like 500K or 64M")
+        except Exception, e:
+            usage("ERROR: %s" % e)
+
+    def createCrawler(self, targetDirectory, startURL):
+        VimeoCrawler.VIMEO_URL = self.server.baseURL + '/%s' # Videos are addressed by vID only
+        crawler = VimeoCrawler.VimeoCrawler(['-d', targetDirectory, '-w', self.driverName, '-z', '-t', '10', startURL])
+        crawler.loggedIn = False
+        crawler.userName = None
+        crawler.totalFileSize = 0
+        crawler.transport = CurlTransport(crawler.timeout)
+        return crawler
+
+    def benchmarkListing(self, crawler, startURL):
+        crawler.graph = VimeoCrawler.CrawlGraph()
+        pagesBefore = self.mock.get('listing')
+        started = time()
+        crawler.getItemsFromURL(startURL)
+        seconds = time() - started
+        pages = self.mock.get('listing') - pagesBefore
+        return {'pages': pages, 'videos': len(crawler.graph), 'folders': len(crawler.graph.folders), 'seconds': seconds, 'pagesPerSecond': pages / seconds if seconds else None,
+                'complete': sorted(crawler.graph.vIDs) == sorted(self.mock.vIDs)}
+
+    def benchmarkProcessVideo(self, crawler):
+        crawler.vIDs = self.mock.vIDs[:self.numProcess]
+        latencies = []
+        linksFound = 0
+        for (n, vID) in enumerate(crawler.vIDs, 1):
+            started = time()
+            video = crawler.processVideo(vID, n)
+            latencies.append(time() - started)
+            if video.link:
+                linksFound += 1
+        result = statistics(latencies)
+        result['linksFound'] = linksFound
+        return result
+
+    def benchmarkDownload(self, crawler, targetDirectory, segments, reactor = None):
+        crawler.segments = segments
+        crawler.segmentSession = createSession(segments, crawler.retryCount) if segments > 1 else None
+        if reactor:
+            (crawler.reactor, crawler.jobs, crawler.downloadSlots) = (reactor, self.numDownloads, BoundedSemaphore(self.numDownloads))
+        else:
+            crawler.downloadPool = WorkerPool(crawler.downloadVideoSafely, 1, 'Download')
+        fileNames = []
+        tasks = []
+        started = time()
+        for vID in self.mock.vIDs[:self.numDownloads]:
+            videoFileName = 'Benchmark %s %d.mp4' % ('reactor' if reactor else segments, vID)
+            fileName = join(targetDirectory, videoFileName)
+            fileNames.append(fileName)
+            link = '%s/files/%d.mp4' % (self.server.baseURL[:-len('/vimeo.com')], vID)
+            job = DownloadJob(vID, link, self.mock.fileSize, fileName, TITLE, (), 'Downloading %d' % vID, videoFileName, {})
+            if reactor:
+                crawler.downloadSlots.acquire()
+                tasks.append(reactor.spawn(crawler.downloadTask(job)))
+            else:
+                crawler.downloadPool.submit(job)
+        if reactor:
+            for task in tasks:
+                task.wait()
+        else:
+            crawler.downloadPool.close()
+        seconds = time() - started
+        crawler.downloadPool = crawler.segmentSession = crawler.reactor = crawler.downloadSlots = None
+        crawler.jobs = 1
+        completed = [fileName for fileName in fileNames if getFileSize(fileName) == self.mock.fileSize]
+        downloaded = len(completed) * self.mock.fileSize
+        for fileName in fileNames:
+            if isfile(fileName):
+                remove(fileName)
+        return {'files': len(fileNames), 'completed': len(completed), 'bytes': downloaded, 'seconds': seconds,
+                'MBps': downloaded / seconds / 1024 / 1024 if seconds else None}
+
+    def run(self):
+        self.mock = MockVimeo(self.numVideos, self.numFolders, self.pageSize, self.fileSize)
+        self.server = MockServer(self.port, self.mock)
+        self.server.start()
+        startURL = '%s/%s' % (self.server.baseURL, ACCOUNT)
+        targetDirectory = mkdtemp(prefix = 'VimeoBenchmark-')
+        results = {'settings': {'videos': self.numVideos, 'folders': self.numFolders, 'pageSize': self.pageSize, 'fileSize': self.fileSize,
+                                'downloads': self.numDownloads, 'segments': self.segments, 'webdriver': self.driverName if self.useBrowser else None,
+                                'lxml': VimeoCrawler.parseHTML is not None, 'server': self.server.baseURL}}
+        crawler = self.createCrawler(targetDirectory, startURL)
+        reactor = None
+        try:
+            results['listing'] = {}
+            if requests:
+                crawler.listing = HTTPListing(crawler.timeout, crawler.retryCount)
+                results['listing']['http'] = self.benchmarkListing(crawler, startURL)
+                cache = PageCache(join(targetDirectory, 'Benchmark.cache'), 0, 1024 ** 3, 3600)
+                crawler.listing = HTTPListing(crawler.timeout, crawler.retryCount, cache = cache)
+                self.benchmarkListing(crawler, startURL) # Fills the cache
+                cache.stats = dict.fromkeys(cache.stats, 0)
+                results['listing']['revalidated'] = self.benchmarkListing(crawler, startURL)
+                results['listing']['revalidated']['hitRate'] = cache.hitRate()
+                cache.close()
+                crawler.listing = None
+                crawler.api = VimeoAPI(self.server.baseURL[:-len('/vimeo.com')] + '/api', 'benchmark', crawler.timeout, crawler.retryCount)
+                results['listing']['api'] = self.benchmarkListing(crawler, startURL)
+                crawler.api = None
+                (crawler.apiVideos, crawler.apiFolders) = ({}, {})
+            else:
+                results['listing']['http'] = results['listing']['api'] = {'skipped': "Requests library is not available"}
+            reactor = Reactor(dict(REACTOR_LIMITS, probe = 1, download = max(1, self.numDownloads)), crawler.timeout, crawler.transport.share)
+            crawler.listing = ReactorListing(reactor)
+            results['listing']['reactor'] = self.benchmarkListing(crawler, startURL)
+            crawler.listing = None
+            if self.useBrowser:
+                crawler.startDriver()
+                try:
+                    results['listing']['browser'] = self.benchmarkListing(crawler, startURL)
+                    if self.numProcess:
+                        results['processVideo'] = self.benchmarkProcessVideo(crawler)
+                finally:
+                    crawler.closeDriver()
+            if self.numDownloads:
+                results['download'] = {'stream': self.benchmarkDownload(crawler, targetDirectory, 1)}
+                if requests and self.segments > 1:
+                    results['download']['segmented'] = self.benchmarkDownload(crawler, targetDirectory, self.segments)
+                else:
+                    results['download']['segmented'] = {'skipped': "Requests library is not available" if self.segments > 1 else "--segments is 1"}
+                results['download']['reactor'] = self.benchmarkDownload(crawler, targetDirectory, 1, reactor)
+            results['errors'] = crawler.errors
+            results['phases'] = crawler.metrics.report()['phases']
+        finally:
+            if reactor:
+                reactor.close()
+            crawler.transport.close()
+            crawler.progressDisplay.close()
+            self.server.shutdown()
+            crawler.stateDatabase.close()
+            if hasattr(crawler, 'errorHandler'):
+                crawler.errorHandler.close()
+                VimeoCrawler.getLogger().removeHandler(crawler.errorHandler)
+                remove(crawler.errorLogFileName)
+            if self.keep:
+                results['directory'] = targetDirectory
+            else:
+                rmtree(targetDirectory, True)
+        if self.outputFileName:
+            with open(self.outputFileName, 'wb') as f:
+                jsonDump(results, f, indent = 2, sort_keys = True)
+        else:
+            jsonDump(results, stdout, indent = 2, sort_keys = True)
+            stdout.write('\n')
+        return results
+
+def main(args):
+    VimeoBenchmark(args).run()
+
+if __name__ == '__main__':
+    main(argv[1:])
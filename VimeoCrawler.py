@@ -1,18 +1,31 @@
 #!/usr/bin/python
+from calendar import timegm
+from cgi import escape
 from codecs import open as codecsOpen
+from collections import deque
+from contextlib import contextmanager
 from getopt import getopt
+from hashlib import sha256
+from HTMLParser import HTMLParser
 from itertools import count
+from json import dump as jsonDump, dumps as jsonDumps, load as jsonLoad, loads as jsonLoads
 from logging import getLogger, FileHandler, StreamHandler, Filter, Formatter, DEBUG, INFO, WARNING
-from os import close, fdopen, listdir, makedirs, remove
-from os.path import basename, getmtime, getsize, isdir, isfile, join, lexists
+from mmap import mmap, ACCESS_READ
+from os import close, fdopen, fstat, fsync, listdir, lstat, makedirs, remove, rename, stat
+from os.path import basename, dirname, getsize, isdir, isfile, join, lexists, relpath
+from multiprocessing import cpu_count
+from Queue import Queue
 from re import compile as reCompile
+from sqlite3 import connect
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 from subprocess import Popen, PIPE, STDOUT
 from sys import argv, exit as sysExit, getfilesystemencoding, platform, stdout
 from tempfile import mkstemp
-from time import sleep, time
+from threading import BoundedSemaphore, Event, Lock, RLock, Thread, local
+from time import sleep, strptime, time
 from traceback import format_exc
+from urlparse import parse_qsl, urljoin, urlparse
 
-# ToDo: Unify urlgrabber operations
 # ToDo: Download HD mp4 video version also
 # ToDo: Add option for that
 
@@ -24,7 +37,7 @@ try: # Selenium configuration
     if tuple(int(v) for v in selenium.__version__.split('.')) < (2, 53):
         raise ImportError('Selenium version %s < 2.53' % selenium.__version__)
     from selenium import webdriver
-    from selenium.common.exceptions import NoSuchElementException, TimeoutException
+    from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
     from selenium.webdriver.common.by import By
     from selenium.webdriver.common.keys import Keys
     from selenium.webdriver.support.expected_conditions import presence_of_element_located, presence_of_all_elements_located
@@ -34,34 +47,12 @@ except ImportError, ex:
     print "%s: %s\nERROR: This software requires Selenium.\nPlease install Selenium v2.53 or later: https://pypi.python.org/pypi/selenium\n" % (ex.__class__.__name__, ex)
     sysExit(-1)
 
-try: # pycurl downloader library, required by urlgrabber
-    import pycurl # pylint: disable=W0611
+try: # pycurl downloader library, used to download files
+    import pycurl
 except ImportError, ex:
     print "%s: %s\nERROR: This software requires pycurl.\nPlease install pycurl v7.19.3.1 or later: https://pypi.python.org/pypi/pycurl\n" % (ex.__class__.__name__, ex)
     sysExit(-1)
 
-try: # urlgrabber downloader library, used to download files, requires pycurl
-    import urlgrabber
-    from urlgrabber.grabber import URLGrabber, URLGrabError
-    if tuple(int(v) for v in urlgrabber.__version__.split('.')) < (3, 10):
-        if tuple(int(v) for v in urlgrabber.__version__.split('.')) < (3, 9, 1):
-            raise ImportError('urlgrabber version %s < 3.9.1' % urlgrabber.__version__)
-        else:
-            print """
-WARNING: You're using urlgrabber 3.9.1 which contains a known error.
-Please use urlgrabber 3.10 or later whenever possible,
-otherwise (on Windows) patch the urlgrabber source:
-Locate the file C:\\Python27\\Lib\\site-packages\\urlgrabber\\grabber.py
-and in line 1161 replace
-\tself.curl_obj.setopt(pycurl.SSL_VERIFYHOST, opts.ssl_verify_host)
-with
-\tself.curl_obj.setopt(pycurl.SSL_VERIFYHOST, 0)
-See https://ask.fedoraproject.org/en/question/35874/yum-pycurl-error-43/ for details.
-"""
-except ImportError, ex:
-    print "%s: %s\nERROR: This software requires urlgrabber.\nPlease install urlgrabber v3.9.1, preferably 3.10 or later: https://pypi.python.org/pypi/urlgrabber\n" % (ex.__class__.__name__, ex)
-    sysExit(-1)
-
 try: # Requests HTTP library, used to get remote file size
     import requests
     if tuple(int(v) for v in requests.__version__.split('.')) < (2, 3, 0):
@@ -70,17 +61,31 @@ except ImportError, ex:
     requests = None
     print "%s: %s\nWARNING: Video file size information will not be available.\nPlease install Requests v2.3.0 or later: https://pypi.python.org/pypi/requests\n" % (ex.__class__.__name__, ex)
 
-try:
-    from PIL.Image import VERSION as __PIL_version__, open as imageOpen
-    if tuple(int(v) for v in __PIL_version__.split('.')) < (1, 1, 7):
-        raise ImportError('PIL version %s < 1.1.7' % requests.__version__)
-except ImportError, ex:
-    imageOpen = None
-    print "%s: %s\nWARNING: Video thumbnail image verification will not be available.\nPlease install Pillow v3.2.0 or later: https://pypi.python.org/pypi/Pillow\n" % (ex.__class__.__name__, ex)
+try: # lxml HTML parser, used by the HTTP listing backend, the standard library parser is used if not available
+    from lxml.html import fromstring as parseHTML
+except ImportError:
+    parseHTML = None
+
+try: # scandir directory iterator, lists a directory with file types and sizes much faster than listdir() and stat(), built into Python 3.5+
+    from os import scandir # pylint: disable=E0611
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try: # fallocate() system call, used to preallocate the files being downloaded on Linux
+    from ctypes import CDLL, c_int, c_longlong
+    from ctypes.util import find_library
+    fallocate = getattr(CDLL(find_library('c'), use_errno = True), 'fallocate64')
+    fallocate.argtypes = (c_int, c_int, c_longlong, c_longlong)
+except (ImportError, OSError, AttributeError, TypeError):
+    fallocate = None
 
 try: # Filesystem symbolic links configuration
-    from os import link as hardlink, symlink # UNIX # pylint: disable=E0611
+    from os import link as hardlink, readlink, symlink # UNIX # pylint: disable=E0611
 except ImportError:
+    readlink = None # Existing symbolic links are taken as pointing to their files
     try:
         from ctypes import windll # Windows
         dll = windll.LoadLibrary('kernel32.dll')
@@ -98,10 +103,12 @@ isWindows = platform.lower().startswith('win')
 
 TITLE = 'VimeoCrawler v2.15 (c) 2013-2016 Vasily Zakharov vmzakhar@gmail.com'
 
-OPTION_NAMES = ('directory', 'folders', 'login', 'max-items', 'retries', 'pause', 'set-language', 'embed-preset', 'timeout', 'webdriver')
-FIELD_NAMES = ('targetDirectory', 'foldersSubdirectory', 'credentials', 'maxItems', 'retryCount', 'pause', 'setLanguage', 'setPreset', 'timeout', 'driverName')
+OPTION_NAMES = ('backend', 'directory', 'folders', 'jobs', 'login', 'max-items', 'retries', 'pause', 'set-language', 'embed-preset', 'timeout', 'webdriver')
+FIELD_NAMES = ('backend', 'targetDirectory', 'foldersSubdirectory', 'jobs', 'credentials', 'maxItems', 'retryCount', 'pause', 'setLanguage', 'setPreset', 'timeout', 'driverName')
+LONG_OPTION_NAMES = ('probes', 'segments', 'browsers', 'remote', 'rate-limit', 'page-rate', 'metrics', 'prometheus', 'engine', 'cache-ttl', 'cache-size', 'cache-age', 'token', 'api-url', 'fsync') # Options with parameters that have no short form
+LONG_FIELD_NAMES = ('probes', 'segments', 'browsers', 'remoteURL', 'rateLimit', 'pageRate', 'metricsFileName', 'prometheusFileName', 'engine', 'cacheTTL', 'cacheSize', 'cacheAge', 'apiToken', 'apiURL', 'fsync')
 SHORT_OPTIONS = ''.join(('%c:' % option[0]) for option in OPTION_NAMES) + 'hvunzcxo'
-LONG_OPTIONS = tuple(('%s=' % option) for option in OPTION_NAMES) + ('help', 'verbose', 'update', 'no-download', 'no-filesize', 'verify-content', 'verify-existing', 'detect-obsolete', 'hard-links', 'thumbnails', 'details')
+LONG_OPTIONS = tuple(('%s=' % option) for option in OPTION_NAMES + LONG_OPTION_NAMES) + ('help', 'verbose', 'update', 'no-download', 'no-filesize', 'verify-content', 'verify-existing', 'detect-obsolete', 'hard-links', 'thumbnails', 'details', 'revisit', 'verify-only', 'resume', 'deduplicate', 'precheck-duplicates', 'reverify')
 OPTION_PATTERNS = tuple(reCompile(pattern) for pattern in (r'-([^-\s])', r'--(\S+)'))
 
 USAGE_INFO = '''Usage: python VimeoCrawler.py [options] [startURL|videoID videoID ...]
@@ -120,29 +127,71 @@ Options:
 -h --help - Displays this help message.
 -v --verbose - Provide verbose logging.
 -n --no-download - Crawl only, do not download anything.
--u --update - Process only newer videos that were not fully processed before.
+-u --update - Process only newer videos that were not fully processed before,
+              stop reading every folder at the first page of already downloaded videos.
 -f --folders - Path to create subfolders with links for channels and albums, defaults to not create links.
 -z --no-filesize - Do not get file sizes for videos (speeds up crawling a bit).
    --hard-links - Use hard links instead of symbolic links in subfolders.
-   --thumbnails - Save video thumbnail images.
+   --deduplicate - Replace every downloaded file identical to a file of another video with a hard link to that file.
+                   SHA-256 of every file is computed during the download and kept in the state database.
+   --precheck-duplicates - Don't download a file which size and head and tail samples match a file of another video,
+                           link to that file instead, implies --deduplicate.
+   --thumbnails - Save video thumbnail images, downloaded concurrently, the images not changed since they were saved are not downloaded again.
    --details - Save HTML video details.
+   --revisit - Visit all video pages, even those the state database shows as completely downloaded and unchanged.
+   --cache-ttl - Enables the page cache, which keeps the results parsed from listing and video pages in the target directory.
+                 Pages processed less than this number of seconds ago are not fetched again,
+                 older listing pages are fetched with conditional requests and reused if unchanged.
+                 Download links on video pages expire, so keep it well below their lifetime, e.g. 3600.
+   --cache-size - Maximum size of the page cache, K, M and G suffixes are allowed, default is 64M.
+   --cache-age - Number of days after which pages not used are removed from the page cache, default is 30.
+   --resume - Continue the crawl interrupted in the previous run from its journal, instead of starting it over.
+              If that crawl was complete, go straight to processing the videos it found.
 
 -l --login - Vimeo login credentials, formatted as email:password.
 -d --directory - Target directory to save all the output files to, default is the current directory.
 
 -w --webdriver - Selenium WebDriver to use for crawling, default is Firefox.
+   --browsers - Number of browser sessions to process video pages in parallel, default is 1.
+   --remote - URL of a Selenium Grid or standalone Selenium server to run browser sessions at, e.g. http://localhost:4444/wd/hub.
+-b --backend - Backend to read album, channel and video listing pages with, browser (default), http or api.
+               The http backend reads static pages directly, using the browser cookies, and is much faster.
+               The api backend reads the listings and the video information from Vimeo API, 100 videos per request,
+               with the download links and sizes, without a browser, it requires --token instead of login credentials.
+   --token - Vimeo API personal access token, with the private and video_files scopes, for the api backend.
+   --api-url - Vimeo API URL, default is https://api.vimeo.com.
 -t --timeout - Download attempt timeout, default is 3 seconds.
 -r --retries - Number of page download retry attempts, default is 3.
 -p --pause - Pause (in seconds) between video retrievals (helps avoid reCAPTCHA).
+   --page-rate - Maximum number of page navigations per minute, spaced evenly (helps avoid reCAPTCHA without idle pauses).
+                 The rate is lowered automatically on every reCAPTCHA or unidentified page, and recovers slowly after that.
+   --rate-limit - Maximum total download bandwidth in bytes per second, over all concurrent downloads, K, M and G suffixes are allowed, e.g. 2M.
+                  Both limits can be changed during the run by writing lines like "rate-limit 500K" or "page-rate off"
+                  to the VimeoCrawler.limits file in the target directory, it's checked every few seconds.
+-j --jobs - Number of concurrent downloads, default is 1 (download in the crawling thread).
+   --segments - Number of parallel connections to download each large file with, using HTTP Range requests, default is 1.
+   --fsync - When to force the downloaded data to the disk: never (default, left to the OS), end (when a file is complete),
+             or a size, K, M and G suffixes are allowed, e.g. 64M to sync every time that much is written to a file.
+   --probes - Number of videos to process in the browser ahead of downloading, so that their file sizes are probed concurrently, default is 1.
+   --engine - Engine to run the network operations with, threads (default) or reactor.
+              The reactor engine runs listing page fetches, file size probes, thumbnail and file downloads
+              as coroutines over a single pycurl multi handle, so that many transfers are in flight without a thread for each.
 -m --max-items - Maximum number of items (videos or folders) to retrieve from one page (usable for testing), default is none.
 -s --set-language - Try to set the specified language on all crawled videos.
 -e --embed-preset - Try to set the specified embed preset on all crawled videos.
    --hd - Try to set all crawled videos to embed as HD.
 -c --verify-content - Verify downloaded files to be valid video files, requires ffmpeg to be available in the path.
 -x --verify-existing - Verify already downloaded files to be valid video files, requires ffmpeg to be available in the path.
+   --verify-only - Verify the files already in the target directory, without crawling, as --verify-existing does.
+   --reverify - Verify existing files again, even those verified OK before and unchanged since, implies --verify-existing.
+Files verified OK before are not verified again unless their size or modification time has changed,
+if only the modification time has, the file content is checked against the SHA-256 hash recorded instead.
+Verification runs in the background, in as many ffmpeg processes as there are CPUs.
 -o --detect-obsolete - Report existing downloaded files not checked during the run.
+   --metrics - File to save the JSON report with timings of every processing phase to, at the end of the run.
+   --prometheus - Prometheus textfile collector file to export the timings to, updated during the run.
 
-If start URL is not specified, the login credentials have to be specified.
+If start URL is not specified, the login credentials or API token have to be specified, unless --verify-only is used.
 In that case, the whole account for those credentials would be crawled.
 '''
 
@@ -155,19 +204,33 @@ def usage(error = None):
     sysExit(2 if error else 0)
 
 LOG_FILE_NAME = 'VimeoCrawler.log'
+STATE_FILE_NAME = 'VimeoCrawler.db'
+JOURNAL_FILE_NAME = 'VimeoCrawler.journal'
+CACHE_FILE_NAME = 'VimeoCrawler.cache'
+LIMITS_FILE_NAME = 'VimeoCrawler.limits'
+LIMITS_CHECK_INTERVAL = 5 # seconds between checks of the limits file for changes
 
 VIMEO = 'vimeo.com'
 VIMEO_URL = 'https://%s/%%s' % VIMEO
+VIMEO_API_URL = 'https://api.%s' % VIMEO
 
-HTTP_ERROR_PATTERN = reCompile(r'.*"(.*)"$')
 
 SYSTEM_LINKS = ('about', 'blog', 'categories', 'channels', 'cookie_policy', 'couchmode', 'creativecommons', 'creatorservices', 'dmca', 'enhancer', 'everywhere', 'explore', 'groups', 'help', 'jobs', 'join', 'log_in', 'love', 'musicstore', 'ondemand', 'plus', 'privacy', 'pro', 'robots.txt', 'search', 'site_map', 'staffpicks', 'terms', 'upload', 'videoschool') # http://vimeo.com/link
 CATEGORIES_LINKS = ('albums', 'groups', 'channels') # http://vimeo.com/account/category
 VIDEOS_LINKS = ('videos') # http://vimeo.com/account/videos
 FOLDERS_LINKS = ('album', 'groups', 'channels') # http://vimeo.com/folder/*
 FOLDER_NAMES = {'albums': 'album', 'groups': 'group', 'channels': 'channel'} # Mapping to singular for printing
+BACKENDS = ('browser', 'http', 'api')
+FOLDER_API_PATHS = {'album': '/me/albums/%s', 'channels': '/channels/%s', 'groups': '/groups/%s'} # Vimeo API lookup of the folders not found in a listing
+ENGINES = ('threads', 'reactor')
+REACTOR_LIMITS = {'listing': 8, 'thumbnail': 8} # Maximum numbers of concurrent transfers in the reactor stages not limited by the options
+FSYNC_POLICIES = ('never', 'end') # Besides a size to sync after
+FALLOC_FL_KEEP_SIZE = 1 # fallocate() mode that doesn't change the file size, so that the downloads are still resumed from the file size
+
 FILE_PREFERENCES = ('Original', '1080p60', '1080p', '720p60', '720p', 'On2 HD', 'HD', 'On2 SD', 'SD') # Vimeo file versions names
 
+JPEG_MAGIC = '\xff\xd8\xff' # Start Of Image marker followed by the first segment marker, thumbnail images are checked for it
+
 BG_IMAGE_PATTERN = reCompile(r'(?i).*url\(\s*[\'"]?\s*(.*?)\s*[\'"]?\s*\)') # url("https://i.vimeocdn.com/video/52925938.jpg?mw=960&mh=540")
 
 UNITS = ('bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB')
@@ -182,6 +245,18 @@ def readableSize(size):
         fSize = '%.0f' % size
     return '%s %s' % (fSize, unit) # pylint: disable=W0631
 
+def readableTime(seconds):
+    (minutes, seconds) = divmod(int(round(seconds)), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return ('%dh %02dm %02ds' % (hours, minutes, seconds)) if hours else ('%dm %02ds' % (minutes, seconds)) if minutes else ('%ds' % seconds)
+
+def parseSize(size):
+    '''Parses a size like 500K or 2M to the number of bytes.'''
+    size = str(size).strip().upper().rstrip('B')
+    units = tuple(unit[0] for unit in UNITS[1:])
+    multiplier = 1024 ** (units.index(size[-1]) + 1) if size and size[-1] in units else 1
+    return int(float(size[:-1] if multiplier > 1 else size) * multiplier)
+
 INVALID_FILENAME_CHARS = '<>:"/\\|?*\'' # for file names, to be replaced with _
 def cleanupFileName(fileName):
     return ''.join('_' if c in INVALID_FILENAME_CHARS else c for c in fileName)
@@ -200,8 +275,24 @@ def getFileSize(fileName):
     except Exception:
         return None
 
+def getVIDFromFileName(fileName):
+    try:
+        return int(fileName[fileName.rfind(' ') + 1 : fileName.rfind('.')])
+    except ValueError:
+        return None
+
+def createSession(numConnections, retryCount):
+    '''Returns Requests session keeping up to the specified number of connections per host alive.'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = numConnections, pool_maxsize = numConnections, max_retries = retryCount)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class URL(object):
     FILE_NAME = 'source.url'
+    __slots__ = ('url', 'isSystem', 'isVideo', 'isAccount', 'isCategory', 'isVideos', 'isFolder', 'vID', 'account', 'category', 'folder', 'name') # Listings of large accounts produce lots of these
+
     def __init__(self, url):
         if hasattr(url, 'url'):
             url = url.url
@@ -250,23 +341,1736 @@ class URL(object):
     def __cmp__(self, other):
         return cmp(self.url, other.url)
 
+def journalItem(item):
+    '''Returns the crawl journal representation of an URL, vID for videos.'''
+    return item.vID if item.isVideo else item.url
+
+class CrawlJournal(object):
+    '''Append-only journal of the crawl, replayed by --resume to restore the crawl graph and the frontier.
+
+    Every line is a JSON record:
+    {"start": url} - the crawl started at the URL
+    {"expand": url, "folder": n} - expanding the next URL from the frontier, belonging to folder number n
+    {"dir": dirName} - the URL being expanded is a new folder
+    {"page": [vID or url, ...], "next": url} - a page of the URL being expanded was read, next is the next page link
+    {"done": true} - the URL is expanded, its items are pushed to the frontier
+    {"complete": true} - the frontier is empty, the crawl is complete
+    '''
+    def __init__(self, fileName, resume):
+        self.fileName = fileName
+        self.resume = resume
+        self.file = None # Opened on the first write, so that runs that don't crawl don't reset the journal
+
+    def load(self):
+        '''Returns the records, dropping the last line if it was cut short by the interruption.'''
+        try:
+            with open(self.fileName, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return []
+        records = []
+        self.validSize = 0
+        for line in data.split('\n')[:-1]: # The last part is either empty or an incomplete line
+            try:
+                records.append(jsonLoads(line))
+            except ValueError:
+                break
+            self.validSize += len(line) + 1
+        return records
+
+    def write(self, **record):
+        if not self.file:
+            if self.resume and isfile(self.fileName):
+                self.load()
+                self.file = open(self.fileName, 'r+b')
+                self.file.truncate(self.validSize)
+                self.file.seek(self.validSize)
+            else:
+                self.file = open(self.fileName, 'wb')
+        self.file.write(jsonDumps(record, separators = (',', ':')) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class CrawlGraph(object):
+    '''Videos found while crawling, as an ordered set, with the index of the folders every video belongs to.'''
+    def __init__(self):
+        self.vIDs = [] # In the order found
+        self.known = set()
+        self.folders = [] # Folder directory names, indexed by folder number
+        self.videoFolders = {} # vID => tuple of folder numbers
+
+    def __len__(self):
+        return len(self.vIDs)
+
+    def __contains__(self, vID):
+        return vID in self.known
+
+    def addFolder(self, dirName):
+        '''Returns the number of the new folder.'''
+        self.folders.append(dirName)
+        return len(self.folders) - 1
+
+    def addVideo(self, vID, folder = None):
+        '''Adds the video, belonging to the specified folder number, if any, returns True if the video is new.'''
+        isNew = vID not in self.known
+        if isNew:
+            self.known.add(vID)
+            self.vIDs.append(vID)
+        if folder is not None:
+            folders = self.videoFolders.get(vID, ())
+            if folder not in folders:
+                self.videoFolders[vID] = folders + (folder,)
+        return isNew
+
+    def getFolders(self, vID):
+        '''Returns directory names of the folders the video belongs to.'''
+        return tuple(self.folders[folder] for folder in self.videoFolders.get(vID, ()))
+
+class WorkerPool(object):
+    '''Runs the specified function for every submitted job in a number of daemon threads.'''
+    def __init__(self, function, numThreads, name, queueSize = 0):
+        self.function = function
+        self.queue = Queue(queueSize)
+        self.threads = tuple(Thread(target = self.work, name = '%s-%d' % (name, n)) for n in xrange(1, numThreads + 1))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.function(job)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, job):
+        self.queue.put(job) # Blocks if the queue is full, so that the producer doesn't get too far ahead
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            while thread.isAlive():
+                thread.join(1) # Timeout keeps the main thread responsive to KeyboardInterrupt
+
+class TokenBucket(object):
+    '''Thread-safe token bucket, consume() blocks the calling thread until the requested amount fits the rate.
+
+    Tokens are allowed to go into debt, so a large request is admitted immediately
+    and the following requests wait for the debt to be paid off.
+    '''
+    def __init__(self, rate, capacity = None):
+        self.lock = Lock()
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.timestamp = time()
+
+    def refill(self):
+        now = time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def setRate(self, rate, capacity = None):
+        with self.lock:
+            self.refill()
+            self.rate = float(rate)
+            self.capacity = float(capacity or self.capacity)
+
+    def consume(self, amount = 1):
+        '''Takes the specified amount of tokens, sleeping until they are available, returns the time slept.'''
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            sleep(delay)
+        return delay
+
+class NavigationPacer(object):
+    '''Adapts the page navigation rate to what the site tolerates, shared by all the browsers.
+
+    Every captcha or unidentified page halves the rate, measured over the last minute if it's not limited yet,
+    then every minute without such events adds RECOVERY of the ceiling, which is --page-rate or the rate before the first backoff.
+    While a captcha waits for the user, wait() blocks the navigations of all the threads.
+    '''
+    DECREASE = 0.5
+    RECOVERY = 0.05 # of the ceiling, every minute
+    MIN_RATE = 1 # page per minute
+    MIN_CEILING = 12 # pages per minute, recovery goes at least this far, even if fewer navigations were measured, e.g. with --pause
+    WINDOW = 60 # seconds the unlimited rate is measured over
+
+    def __init__(self, maxRate = None):
+        self.lock = Lock()
+        self.maxRate = maxRate # pages per minute, None if unlimited
+        self.ceiling = maxRate # Recovery stops here, unlimited again if there's no --page-rate
+        self.rate = maxRate
+        self.bucket = TokenBucket(maxRate / 60, 1) if maxRate else None # No bursts, navigations are spaced evenly
+        self.recent = deque() # Times of the navigations in the last WINDOW seconds
+        self.lastChange = time()
+        self.clear = Event() # Not set while a captcha is pending
+        self.clear.set()
+        self.pending = 0 # Captchas waiting for the user
+
+    @property
+    def limited(self):
+        return self.bucket is not None
+
+    def wait(self):
+        '''Blocks until the next navigation is allowed, returns the time waited.'''
+        started = time()
+        while not self.clear.wait(1): # Timeout keeps the main thread responsive to KeyboardInterrupt
+            pass
+        bucket = self.bucket
+        if bucket:
+            bucket.consume()
+        now = time()
+        with self.lock:
+            self.recent.append(now)
+            while self.recent[0] < now - self.WINDOW:
+                self.recent.popleft()
+        return now - started
+
+    def success(self):
+        '''Recovers the rate after a navigation reaching the expected page.'''
+        with self.lock:
+            if self.rate is None:
+                return
+            if self.rate >= self.ceiling:
+                if not self.maxRate: # Recovered, e.g. the ceiling was lowered by setMaxRate()
+                    (self.rate, self.bucket) = (None, None)
+                return
+            now = time()
+            self.rate = min(self.ceiling, self.rate + self.RECOVERY * self.ceiling * (now - self.lastChange) / 60)
+            self.lastChange = now
+            if self.rate >= self.ceiling and not self.maxRate:
+                (self.rate, self.bucket) = (None, None)
+            else:
+                self.bucket.setRate(self.rate / 60)
+
+    def backoff(self):
+        '''Decreases the rate after a captcha or an unidentified page, returns the new rate.'''
+        with self.lock:
+            if self.rate is None: # A single navigation, e.g. to the login page, doesn't tell the rate
+                measured = len(self.recent) * 60 / max(time() - self.recent[0], 1.0) if len(self.recent) > 1 else 0
+                self.rate = self.ceiling = max(self.MIN_CEILING, measured)
+            self.rate = max(self.MIN_RATE, self.rate * self.DECREASE)
+            self.lastChange = time()
+            if self.bucket:
+                self.bucket.setRate(self.rate / 60)
+            else:
+                self.bucket = TokenBucket(self.rate / 60, 1)
+            return self.rate
+
+    def setMaxRate(self, maxRate):
+        '''Changes the --page-rate limit during the run, None means unlimited, a lowered rate recovers up to the new limit.'''
+        with self.lock:
+            self.maxRate = self.ceiling = maxRate
+            if not maxRate:
+                (self.rate, self.bucket) = (None, None)
+                return
+            self.rate = min(self.rate or maxRate, maxRate)
+            self.lastChange = time()
+            if self.bucket:
+                self.bucket.setRate(self.rate / 60)
+            else:
+                self.bucket = TokenBucket(self.rate / 60, 1)
+
+    def block(self):
+        '''Stops the navigations of the other threads until unblock() is called.'''
+        with self.lock:
+            self.pending += 1
+            self.clear.clear()
+
+    def unblock(self):
+        with self.lock:
+            self.pending -= 1
+            if not self.pending:
+                self.clear.set()
+
+class Metrics(object):
+    '''Thread-safe counters and histograms of the time spent in every processing phase.'''
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800) # seconds
+    PREFIX = 'vimeo_crawler'
+    TEXT_FILE_INTERVAL = 15 # seconds between Prometheus textfile updates
+
+    def __init__(self, textFileName = None):
+        self.lock = Lock()
+        self.textFileName = textFileName
+        self.started = time()
+        self.textFileWritten = 0
+        self.textFileFailed = False # The error is logged once, not for every update
+        self.counters = {}
+        self.phases = {} # phase => [count, sum, max, bucket counts]
+
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            stats = self.phases.get(phase)
+            if not stats:
+                stats = self.phases[phase] = [0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            for (i, bound) in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats[3][i] += 1
+            if not self.textFileName or time() < self.textFileWritten + self.TEXT_FILE_INTERVAL:
+                return
+            self.textFileWritten = time()
+        self.updateTextFile()
+
+    def updateTextFile(self):
+        '''Writes the textfile during the run, an error doesn't fail the operation being measured, the next update is tried after the interval.'''
+        try:
+            self.writeTextFile()
+            self.textFileFailed = False
+        except (IOError, OSError), e:
+            if not self.textFileFailed:
+                self.textFileFailed = True
+                getLogger('vimeo').warning("Error writing metrics textfile, will retry: %s", e)
+
+    @contextmanager
+    def timer(self, phase):
+        started = time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time() - started)
+
+    def report(self):
+        with self.lock:
+            return {'started': self.started, 'seconds': time() - self.started, 'counters': dict(self.counters),
+                    'phases': dict((phase, {'count': n, 'sum': total, 'mean': total / n, 'max': maximum, 'buckets': dict(('%g' % bound, c) for (bound, c) in zip(self.BUCKETS, buckets))})
+                                   for (phase, (n, total, maximum, buckets)) in self.phases.iteritems())}
+
+    def writeReport(self, fileName):
+        with open(fileName, 'wb') as f:
+            jsonDump(self.report(), f, indent = 2, sort_keys = True)
+
+    def writeTextFile(self):
+        '''Writes metrics in Prometheus text format, replacing the file at once so that the collector never reads it half-written.'''
+        report = self.report()
+        lines = ['# HELP %s_phase_seconds Time spent in every phase of processing videos.' % self.PREFIX, '# TYPE %s_phase_seconds histogram' % self.PREFIX]
+        for (phase, stats) in sorted(report['phases'].iteritems()):
+            lines.extend('%s_phase_seconds_bucket{phase="%s",le="%g"} %d' % (self.PREFIX, phase, bound, stats['buckets']['%g' % bound]) for bound in self.BUCKETS)
+            lines.append('%s_phase_seconds_bucket{phase="%s",le="+Inf"} %d' % (self.PREFIX, phase, stats['count']))
+            lines.append('%s_phase_seconds_sum{phase="%s"} %f' % (self.PREFIX, phase, stats['sum']))
+            lines.append('%s_phase_seconds_count{phase="%s"} %d' % (self.PREFIX, phase, stats['count']))
+        lines.extend(('# HELP %s_events_total Number of events of every kind during the run.' % self.PREFIX, '# TYPE %s_events_total counter' % self.PREFIX))
+        lines.extend('%s_events_total{event="%s"} %d' % (self.PREFIX, name, value) for (name, value) in sorted(report['counters'].iteritems()))
+        lines.extend(('# HELP %s_run_seconds Time since the start of the run.' % self.PREFIX, '# TYPE %s_run_seconds gauge' % self.PREFIX, '%s_run_seconds %f' % (self.PREFIX, report['seconds'])))
+        tempFileName = self.textFileName + '.tmp'
+        with open(tempFileName, 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+        if isWindows and isfile(self.textFileName):
+            remove(self.textFileName) # Windows can't rename over an existing file
+        rename(tempFileName, self.textFileName)
+
+class TransferProgress(object):
+    '''Progress of a transfer shown by ProgressDisplay, update() only stores the number, so it's cheap enough to call for every chunk received.'''
+    __slots__ = ('name', 'size', 'done', 'lastTime', 'lastDone', 'rate')
+
+    def __init__(self, name, size, done):
+        self.name = name
+        self.size = size
+        self.done = self.lastDone = done
+        self.lastTime = time()
+        self.rate = 0.0
+
+    def update(self, done):
+        self.done = done
+
+    def sample(self, now):
+        '''Updates the smoothed transfer rate, returns it.'''
+        if now > self.lastTime:
+            self.rate = (self.rate + (self.done - self.lastDone) / (now - self.lastTime)) / 2 if self.rate else (self.done - self.lastDone) / (now - self.lastTime)
+            (self.lastTime, self.lastDone) = (now, self.done)
+        return self.rate
+
+class ProgressDisplay(object):
+    '''Shows the progress of all the running transfers at once, rendered in a thread of its own, RATE times a second.
+
+    On a terminal, a line for every transfer and a total line are redrawn in place, clear() is called before the log records are written under them.
+    Otherwise, a total line is logged every SUMMARY_INTERVAL seconds.
+    '''
+    RATE = 4 # per second
+    SUMMARY_INTERVAL = 30 # seconds
+
+    def __init__(self, stream, logger, interactive):
+        self.stream = stream
+        self.logger = logger
+        self.interactive = interactive
+        self.lock = RLock() # Held by the log handler while it writes a record, which calls clear()
+        self.transfers = []
+        self.numLines = 0 # Drawn on the terminal
+        self.lastSummary = time()
+        self.closed = Event()
+        self.thread = None
+
+    def start(self, name, size, done = 0):
+        '''Returns TransferProgress for the new transfer, to be passed to finish() when it's done.'''
+        progress = TransferProgress(name, size, done)
+        with self.lock:
+            self.transfers.append(progress)
+            if not self.thread:
+                self.thread = Thread(target = self.run, name = 'Progress')
+                self.thread.daemon = True
+                self.thread.start()
+        return progress
+
+    def finish(self, progress):
+        with self.lock:
+            if progress in self.transfers:
+                self.transfers.remove(progress)
+
+    def totalLine(self, rates):
+        rate = sum(rates)
+        remaining = sum(max(0, progress.size - progress.done) for progress in self.transfers if progress.size)
+        return '%d transfer%s at %s/s, %s remaining%s' % (len(self.transfers), '' if len(self.transfers) == 1 else 's', readableSize(rate), readableSize(remaining),
+                                                           (', ETA %s' % readableTime(remaining / rate)) if remaining and rate else '')
+
+    def render(self):
+        now = time()
+        summary = None
+        with self.lock:
+            rates = tuple(progress.sample(now) for progress in self.transfers)
+            if self.interactive:
+                self.clear()
+                if self.transfers:
+                    lines = ['%s  %s%s  %s/s' % (progress.name, readableSize(progress.done), (' / %s  %3d%%' % (readableSize(progress.size), progress.done * 100 // progress.size)) if progress.size else '', readableSize(rate))
+                             for (progress, rate) in zip(self.transfers, rates)]
+                    lines.append(self.totalLine(rates))
+                    self.stream.write(''.join('%s\n' % line for line in lines))
+                    self.numLines = len(lines)
+            elif self.transfers and now >= self.lastSummary + self.SUMMARY_INTERVAL:
+                self.lastSummary = now
+                summary = self.totalLine(rates)
+        if summary: # Logged without the lock, which the log handler takes
+            self.logger.info(summary)
+
+    def clear(self):
+        '''Erases the lines drawn on the terminal.'''
+        with self.lock:
+            if self.numLines:
+                self.stream.write('\x1b[%dA\x1b[J' % self.numLines) # Cursor up, erase to the end of the screen
+                self.numLines = 0
+
+    def run(self):
+        while not self.closed.wait(1.0 / self.RATE):
+            self.render()
+
+    def close(self):
+        self.closed.set()
+        if self.thread:
+            while self.thread.isAlive():
+                self.thread.join(1) # Timeout keeps the main thread responsive to KeyboardInterrupt
+        self.clear()
+
+class Inventory(object):
+    '''Files in the target directory with their sizes and modification times, indexed by vID.
+
+    The directory is scanned once at startup, the files written during the run are updated with refresh().
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = Lock()
+        self.files = {} # unicode file name => (size, mtime)
+        self.vIDs = {} # vID => list of unicode file names
+        self.dirs = set()
+        if scandir:
+            for entry in scandir(unicode(directory)):
+                if entry.is_dir():
+                    self.dirs.add(entry.name)
+                elif entry.is_file():
+                    info = entry.stat()
+                    self.add(entry.name, (info.st_size, info.st_mtime))
+        else:
+            for fileName in listdir(unicode(directory)):
+                info = self.stat(fileName)
+                if info and S_ISDIR(info.st_mode):
+                    self.dirs.add(fileName)
+                elif info and S_ISREG(info.st_mode):
+                    self.add(fileName, (info.st_size, info.st_mtime))
+
+    def stat(self, fileName):
+        try:
+            return stat(encodeForFileSystem(join(self.directory, fileName)))
+        except OSError:
+            return None
+
+    def add(self, fileName, sizeAndMTime):
+        with self.lock:
+            if fileName not in self.files and '.' in fileName:
+                vID = getVIDFromFileName(fileName)
+                if vID is not None:
+                    self.vIDs.setdefault(vID, []).append(fileName)
+            self.files[fileName] = sizeAndMTime
+
+    def get(self, fileName):
+        '''Returns (size, mtime) of the file, or (None, None) if there's no such file.'''
+        return self.files.get(fileName, (None, None))
+
+    def getSize(self, fileName):
+        return self.get(fileName)[0]
+
+    def getFiles(self, vID):
+        with self.lock:
+            return tuple(self.vIDs.get(vID, ()))
+
+    def refresh(self, fileName):
+        '''Updates the information about the file that was written during the run, returns (size, mtime).'''
+        info = self.stat(fileName)
+        if info and S_ISREG(info.st_mode):
+            self.add(fileName, (info.st_size, info.st_mtime))
+            return self.files[fileName]
+        with self.lock:
+            if self.files.pop(fileName, None) and fileName in self.vIDs.get(getVIDFromFileName(fileName), ()):
+                self.vIDs[getVIDFromFileName(fileName)].remove(fileName)
+        return (None, None)
+
+class ContentHash(object):
+    '''SHA-256 of a file computed from the data as it is written, so that the complete file doesn't have to be read again.'''
+    BLOCK_SIZE = 1024 * 1024
+    SAMPLE_SIZE = 64 * 1024
+    HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.file = None
+        self.reset()
+
+    def reset(self):
+        self.hash = sha256()
+        self.size = 0
+
+    def update(self, data, offset):
+        '''Hashes the data written at the offset, if it continues the part of the file hashed so far.'''
+        if offset == self.size:
+            self.hash.update(data)
+            self.size += len(data)
+
+    def follow(self):
+        '''Hashes the data written to the file by another component since the last call, the file is not hashed from the start again.'''
+        try:
+            if not self.file:
+                self.file = open(self.fileName, 'rb')
+            self.file.seek(0, 2)
+            if self.file.tell() < self.size: # The file was truncated and is being written anew
+                self.reset()
+            self.file.seek(self.size)
+            while True:
+                data = self.file.read(self.BLOCK_SIZE)
+                if not data:
+                    break
+                self.hash.update(data)
+                self.size += len(data)
+        except IOError:
+            pass
+
+    def hexdigest(self, size):
+        '''Returns the hash if exactly the specified size of the file has been hashed, None otherwise.'''
+        return self.hash.hexdigest() if size and self.size == size else None
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    @classmethod
+    def sampleDigest(cls, size, head, tail):
+        '''Returns the hash of the size and the head and tail samples of a file, which identifies the content cheaply.'''
+        return sha256('%d\n%s%s' % (size, head, tail)).hexdigest()
+
+    @classmethod
+    def hashFile(cls, fileName):
+        '''Returns SHA-256 of the whole file, reading it memory mapped, or in large blocks if it can't be mapped.'''
+        digest = sha256()
+        with open(fileName, 'rb') as f:
+            size = fstat(f.fileno()).st_size
+            try:
+                data = mmap(f.fileno(), 0, access = ACCESS_READ) if size else None
+            except (EnvironmentError, OverflowError, ValueError): # Address space is too small for the file
+                data = None
+            if data:
+                try:
+                    for offset in xrange(0, size, cls.HASH_BLOCK_SIZE):
+                        digest.update(buffer(data, offset, cls.HASH_BLOCK_SIZE)) # The lock is released while a large block is hashed
+                finally:
+                    data.close()
+            else:
+                for block in iter(lambda: f.read(cls.HASH_BLOCK_SIZE), ''):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    @classmethod
+    def fileSample(cls, fileName, size):
+        '''Returns the sample digest of a local file, reading only its head and tail.'''
+        with open(fileName, 'rb') as f:
+            head = f.read(cls.SAMPLE_SIZE)
+            f.seek(max(0, size - cls.SAMPLE_SIZE))
+            return cls.sampleDigest(size, head, f.read(cls.SAMPLE_SIZE))
+
+class DownloadJob(object):
+    '''All the information needed to download a video file without access to the browser.'''
+    def __init__(self, vID, link, linkSize, fileName, userAgent, cookies, operation, videoFileName, remoteState):
+        self.vID = vID
+        self.link = link
+        self.linkSize = linkSize
+        self.fileName = fileName
+        self.userAgent = userAgent
+        self.cookies = cookies
+        self.operation = operation
+        self.videoFileName = videoFileName
+        self.remoteState = remoteState
+
+class VerifyJob(object):
+    '''A downloaded file to be verified with ffmpeg, or by the content hash if it was verified OK before.'''
+    def __init__(self, vID, fileName, videoFileName, operation, sha256 = None, sample = None):
+        self.vID = vID
+        self.fileName = fileName
+        self.videoFileName = videoFileName
+        self.operation = operation
+        self.sha256 = sha256
+        self.sample = sample
+
+class ThumbnailJob(object):
+    '''A video thumbnail image to be downloaded, etag is the one of the image saved before, if any.'''
+    def __init__(self, vID, link, userAgent, cookies, fileName, targetFileName, etag, operation):
+        self.vID = vID
+        self.link = link
+        self.userAgent = userAgent
+        self.cookies = cookies
+        self.fileName = fileName
+        self.targetFileName = targetFileName
+        self.etag = etag
+        self.operation = operation
+
+class PendingVideo(object):
+    '''Video information collected in the browser, used to complete the video processing later.'''
+    def __init__(self, vID, number):
+        self.vID = vID
+        self.number = number
+        self.isPending = False # False if there's nothing left to do for the video
+        self.updateCompleted = True
+        self.title = ''
+        self.label = ''
+        self.description = 'NONE'
+        self.hasDownload = False
+        self.link = None
+        self.probe = None
+        self.remoteState = {}
+        self.userAgent = None
+        self.cookies = None
+        self.detailsText = ''
+        self.videoThumbnailLink = None
+        self.fileNames = None
+
+class SizeProbe(object):
+    '''Result of a remote file size probe, available after wait().'''
+    def __init__(self, link, userAgent = None, cookies = ()):
+        self.link = link
+        self.userAgent = userAgent # Of the browser session the link was found in, as its cookies were issued to it
+        self.cookies = cookies # Browser cookies
+        self.size = self.etag = self.lastModified = None
+        self.seconds = None
+        self.exception = None
+        self.event = Event()
+        self.task = None # ReactorTask doing the probe, if any
+
+    def wait(self):
+        while not self.event.wait(1): # Timeout keeps the main thread responsive to KeyboardInterrupt
+            if self.task:
+                self.task.check()
+        if self.exception:
+            raise self.exception # pylint: disable=E0702
+        return self
+
+class SizeProber(object):
+    '''Probes remote file sizes concurrently over a pooled HTTP session.'''
+    def __init__(self, numThreads, timeout, retryCount):
+        self.timeout = timeout
+        self.session = createSession(numThreads, retryCount)
+        self.pool = WorkerPool(self.probeSafely, numThreads, 'Probe')
+
+    def probe(self, result):
+        '''Returns (size, etag, lastModified) using HEAD request, or a ranged GET if HEAD doesn't provide the size.'''
+        (link, headers) = (result.link, {'User-Agent': result.userAgent} if result.userAgent else {})
+        cookies = dict((str(cookie['name']), str(cookie['value'])) for cookie in result.cookies) # Every probe is sent with the state of its own browser session
+        response = self.session.head(link, headers = headers, allow_redirects = True, timeout = self.timeout, cookies = cookies)
+        size = response.headers.get('content-length') if response.ok else None
+        if size is None:
+            response = self.session.get(link, headers = dict(headers, Range = 'bytes=0-0'), timeout = self.timeout, cookies = cookies, stream = True)
+            response.close() # Only the headers are needed, a server ignoring the range would send the whole file
+            response.raise_for_status()
+            contentRange = response.headers.get('content-range')
+            size = contentRange.split('/')[-1] if response.status_code == 206 and contentRange else response.headers['content-length']
+        return (int(size), response.headers.get('etag'), response.headers.get('last-modified'))
+
+    def probeSafely(self, result):
+        started = time()
+        try:
+            (result.size, result.etag, result.lastModified) = self.probe(result)
+        except Exception, e:
+            result.exception = e
+        finally:
+            result.seconds = time() - started
+            result.event.set()
+
+    def submit(self, link, userAgent, cookies):
+        result = SizeProbe(link, userAgent, cookies)
+        self.pool.submit(result)
+        return result
+
+    def close(self):
+        self.pool.close()
+
+class Transfer(object):
+    '''HTTP request yielded by a reactor coroutine, which is resumed with the transfer completed, or performed by CurlTransport.
+
+    The response body is written to the file, from the start of the range, if the file name is specified,
+    and is kept in memory otherwise.
+    '''
+    def __init__(self, stage, url, userAgent = None, cookies = None, method = 'GET', fileName = None, start = 0, end = None, maxSpeed = None, hasher = None, requestHeaders = None, progress = None, size = None, fsync = None, rangeOnly = False):
+        self.stage = stage
+        self.url = url
+        self.userAgent = userAgent
+        self.cookies = cookies # Cookie header value
+        self.method = method
+        self.fileName = fileName
+        self.start = start
+        self.end = end
+        self.maxSpeed = maxSpeed
+        self.hasher = hasher # ContentHash of the file, updated with the data written
+        self.requestHeaders = requestHeaders or {}
+        self.progress = progress # Called with the file size after every write
+        self.size = size # Of the whole file, to preallocate
+        self.fsync = fsync # FileWriter fsync policy
+        self.rangeOnly = rangeOnly # The body of a response ignoring the range, likely the whole file, isn't read, only the headers
+        self.file = None
+        self.written = 0 # Bytes written to the file
+        self.writeSeconds = 0.0
+        self.parts = []
+        # Results
+        self.code = None
+        self.headers = {}
+        self.received = 0
+        self.effectiveURL = url
+        self.error = None
+        self.truncated = False # The body was dropped because of rangeOnly
+        self.failure = None # Exception raised while writing the body
+
+    @property
+    def body(self):
+        return ''.join(self.parts)
+
+    @property
+    def ok(self):
+        return not self.error and self.code in (200, 206)
+
+    def check(self):
+        '''Raises IOError if the transfer failed.'''
+        if self.error:
+            raise IOError(self.error)
+        if not self.ok:
+            raise IOError("HTTP error %s: %s" % (self.code, self.url))
+
+    def header(self, line):
+        line = line.strip()
+        if line.startswith('HTTP/'): # Status line, the headers of the previous responses in a redirect chain are dropped
+            self.headers = {}
+            try:
+                self.code = int(line.split()[1])
+            except (IndexError, ValueError):
+                pass
+        elif ':' in line:
+            (name, value) = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+    def write(self, data):
+        try:
+            return self.receive(data)
+        except Exception, e: # pycurl would only print it, the transfer is aborted with it as the error
+            self.failure = '%s: %s' % (e.__class__.__name__, e)
+            return 0
+
+    def receive(self, data):
+        if self.rangeOnly and self.code != 206:
+            self.truncated = True
+            return 0 # Aborts the transfer
+        if self.fileName and self.code in (200, 206): # Error response body is not written to the file
+            if not self.file:
+                if self.code == 206:
+                    self.file = FileWriter(self.fileName, self.start, self.size, self.fsync)
+                else: # Server ignored the range, the whole file is received
+                    self.file = FileWriter(self.fileName, 0, self.size, self.fsync, True)
+                    if self.hasher:
+                        self.hasher.reset()
+            if self.hasher:
+                self.hasher.update(data, self.file.tell())
+            self.file.write(data)
+            if self.progress:
+                self.progress(self.file.tell())
+        else:
+            self.parts.append(data)
+        self.received += len(data)
+
+    def setup(self, curl, timeout, share = None):
+        curl.setopt(pycurl.URL, str(self.url))
+        if share and getattr(curl, 'shared', None) is not share: # The share is kept by reset()
+            curl.setopt(pycurl.SHARE, share)
+            curl.shared = share
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.MAXREDIRS, 5)
+        curl.setopt(pycurl.NOSIGNAL, 1)
+        curl.setopt(pycurl.CONNECTTIMEOUT, timeout)
+        curl.setopt(pycurl.LOW_SPEED_LIMIT, 1) # Stalled transfers are aborted after timeout seconds
+        curl.setopt(pycurl.LOW_SPEED_TIME, timeout)
+        curl.setopt(pycurl.HEADERFUNCTION, self.header)
+        curl.setopt(pycurl.WRITEFUNCTION, self.write)
+        if self.method == 'HEAD':
+            curl.setopt(pycurl.NOBODY, 1)
+        if self.userAgent:
+            curl.setopt(pycurl.USERAGENT, self.userAgent)
+        if self.cookies:
+            curl.setopt(pycurl.COOKIE, self.cookies)
+        if self.requestHeaders:
+            curl.setopt(pycurl.HTTPHEADER, ['%s: %s' % header for header in self.requestHeaders.iteritems()])
+        if self.start or self.end is not None:
+            curl.setopt(pycurl.RANGE, '%d-%s' % (self.start, '' if self.end is None else self.end))
+        if self.maxSpeed:
+            curl.setopt(pycurl.MAX_RECV_SPEED_LARGE, int(self.maxSpeed))
+
+    def finish(self, curl, error):
+        if self.file:
+            try:
+                self.file.close()
+            except (IOError, OSError), e:
+                error = error or str(e)
+            (self.written, self.writeSeconds) = (self.file.written, self.file.seconds)
+            self.file = None
+        self.error = None if self.truncated else self.failure or error
+        try:
+            self.code = curl.getinfo(pycurl.RESPONSE_CODE) or self.code
+            self.effectiveURL = curl.getinfo(pycurl.EFFECTIVE_URL) or self.url
+        except pycurl.error:
+            pass
+
+class CurlTransport(object):
+    '''Performs transfers in the calling threads, reusing an easy handle per thread.
+
+    DNS and TLS session caches are shared by all the transfers, including those run by the reactor,
+    so that the files from the same hosts don't pay for a full handshake every time.
+    Connections are kept by every easy handle, and by the reactor multi handle, on its own,
+    as libcurl doesn't support sharing the connection cache between concurrent threads.
+    '''
+    SHARED_DATA = (pycurl.LOCK_DATA_DNS, pycurl.LOCK_DATA_SSL_SESSION)
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.share = pycurl.CurlShare()
+        for data in self.SHARED_DATA:
+            self.share.setopt(pycurl.SH_SHARE, data)
+        self.local = local()
+        self.lock = Lock()
+        self.handles = []
+
+    def perform(self, transfer):
+        '''Runs the transfer to completion, returns it.'''
+        curl = getattr(self.local, 'curl', None)
+        if not curl:
+            curl = self.local.curl = pycurl.Curl()
+            with self.lock:
+                self.handles.append(curl)
+        error = None
+        try:
+            transfer.setup(curl, self.timeout, self.share)
+            curl.perform()
+        except pycurl.error, e:
+            error = e.args[-1] or str(e)
+        transfer.finish(curl, error)
+        curl.reset()
+        return transfer
+
+    def close(self):
+        with self.lock:
+            for curl in self.handles:
+                curl.close()
+            self.handles = []
+        self.share.close()
+
+class ReactorTask(object):
+    '''Coroutine run by the reactor, wait() returns when it's finished.'''
+    def __init__(self, coroutine, reactor):
+        self.coroutine = coroutine
+        self.reactor = reactor
+        self.exception = None
+        self.event = Event()
+
+    def check(self):
+        '''Raises IOError if the task can't finish, as the reactor thread is gone.'''
+        if not self.event.isSet() and not self.reactor.thread.isAlive():
+            raise IOError("Reactor stopped")
+
+    def wait(self):
+        while not self.event.wait(1): # Timeout keeps the main thread responsive to KeyboardInterrupt
+            self.check()
+        if self.exception:
+            raise self.exception # pylint: disable=E0702
+
+class Reactor(object):
+    '''Runs coroutines doing HTTP transfers over one pycurl multi handle, in a single thread.
+
+    A coroutine is a generator that yields Transfer objects and is resumed with each of them completed.
+    Every transfer belongs to a stage, the number of transfers of every stage running at once is limited.
+    An exception in a coroutine or in a transfer is delivered to the task it belongs to, the other tasks keep running.
+    '''
+    def __init__(self, limits, timeout, share = None):
+        self.limits = dict(limits)
+        self.timeout = timeout
+        self.share = share # CurlShare of the transport, if any
+        self.multi = pycurl.CurlMulti()
+        self.handles = [] # Idle easy handles, reused
+        self.active = set() # Easy handles added to the multi handle
+        self.running = dict.fromkeys(self.limits, 0)
+        self.waiting = dict((stage, deque()) for stage in self.limits) # (task, transfer)
+        self.inbox = deque() # Tasks spawned from other threads, deque operations are atomic
+        self.speedChanges = deque() # (stage, maxSpeed) set from other threads
+        self.numTasks = 0
+        self.closing = False
+        self.wakeup = Event()
+        self.thread = Thread(target = self.run, name = 'Reactor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def spawn(self, coroutine):
+        '''Starts the coroutine in the reactor thread, can be called from any thread.'''
+        task = ReactorTask(coroutine, self)
+        self.inbox.append(task)
+        self.wakeup.set()
+        return task
+
+    def setMaxSpeed(self, stage, maxSpeed):
+        '''Changes the receive speed limit of the running transfers of the stage, can be called from any thread.'''
+        self.speedChanges.append((stage, maxSpeed))
+        self.wakeup.set()
+
+    def applySpeedChanges(self):
+        while self.speedChanges:
+            (stage, maxSpeed) = self.speedChanges.popleft()
+            for curl in self.active:
+                if curl.transfer.stage == stage:
+                    curl.transfer.maxSpeed = maxSpeed
+                    curl.setopt(pycurl.MAX_RECV_SPEED_LARGE, int(maxSpeed or 0)) # Taken into account by libcurl while the transfer runs, 0 is unlimited
+
+    def step(self, task, transfer):
+        try:
+            transfer = task.coroutine.send(transfer)
+            self.waiting[transfer.stage].append((task, transfer))
+        except StopIteration:
+            self.numTasks -= 1
+            task.event.set()
+        except Exception, e: # Including a transfer of an unknown stage, the coroutine is closed, so that its finally clauses are run
+            self.numTasks -= 1
+            task.exception = e
+            try:
+                task.coroutine.close()
+            except Exception:
+                pass
+            task.event.set()
+
+    def startTransfers(self):
+        for (stage, waiting) in self.waiting.iteritems():
+            while waiting and self.running[stage] < self.limits[stage]:
+                (task, transfer) = waiting.popleft()
+                curl = self.handles.pop() if self.handles else pycurl.Curl()
+                curl.task = task
+                curl.transfer = transfer
+                self.running[stage] += 1
+                try:
+                    transfer.setup(curl, self.timeout, self.share)
+                    self.multi.add_handle(curl)
+                    self.active.add(curl)
+                except Exception, e:
+                    self.finishTransfer(curl, str(e))
+
+    def finishTransfer(self, curl, error = None):
+        (task, transfer) = (curl.task, curl.transfer)
+        try:
+            transfer.finish(curl, error)
+        except Exception, e:
+            transfer.error = error or str(e)
+        if curl in self.active:
+            self.active.remove(curl)
+            try:
+                self.multi.remove_handle(curl)
+            except pycurl.error:
+                pass
+        curl.task = curl.transfer = None
+        curl.reset()
+        self.handles.append(curl)
+        self.running[transfer.stage] -= 1
+        self.step(task, transfer)
+
+    def run(self):
+        while True:
+            try:
+                while self.inbox:
+                    self.numTasks += 1
+                    self.step(self.inbox.popleft(), None)
+                self.applySpeedChanges()
+                self.startTransfers()
+                if not any(self.running.itervalues()):
+                    if self.closing and not self.numTasks and not self.inbox:
+                        break
+                    self.wakeup.wait(1)
+                    self.wakeup.clear()
+                    continue
+                while self.multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                    pass
+                while True:
+                    (numQueued, succeeded, failed) = self.multi.info_read()
+                    for curl in succeeded:
+                        self.finishTransfer(curl)
+                    for (curl, _errno, message) in failed:
+                        self.finishTransfer(curl, message)
+                    if not numQueued:
+                        break
+                self.multi.select(0.1)
+            except Exception, e: # The multi handle failed, the transfers in it are failed too, so that their tasks go on
+                for curl in tuple(self.active):
+                    self.finishTransfer(curl, "Reactor error: %s" % e)
+                sleep(0.1)
+
+    def check(self):
+        '''Raises IOError if the reactor thread is gone.'''
+        if not self.thread.isAlive():
+            raise IOError("Reactor stopped")
+
+    def close(self):
+        '''Waits for all the coroutines to finish.'''
+        self.closing = True
+        self.wakeup.set()
+        while self.thread.isAlive():
+            self.thread.join(1) # Timeout keeps the main thread responsive to KeyboardInterrupt
+        for curl in self.handles:
+            curl.close()
+        self.multi.close()
+
+def cookieHeader(cookies):
+    '''Returns Cookie header value for the browser cookies.'''
+    return '; '.join('%s=%s' % (str(cookie['name']), str(cookie['value'])) for cookie in cookies)
+
+class ReactorProber(object):
+    '''Probes remote file sizes as reactor coroutines, in place of SizeProber.'''
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def probe(self, result):
+        '''Gets the size using HEAD request, or a ranged GET if HEAD doesn't provide it.'''
+        started = time()
+        try:
+            cookies = cookieHeader(result.cookies)
+            transfer = yield Transfer('probe', result.link, result.userAgent, cookies, method = 'HEAD')
+            size = transfer.headers.get('content-length') if transfer.ok else None
+            if size is None:
+                transfer = yield Transfer('probe', result.link, result.userAgent, cookies, end = 0, rangeOnly = True)
+                transfer.check()
+                contentRange = transfer.headers.get('content-range')
+                size = contentRange.split('/')[-1] if transfer.code == 206 and contentRange else transfer.headers['content-length']
+            (result.size, result.etag, result.lastModified) = (int(size), transfer.headers.get('etag'), transfer.headers.get('last-modified'))
+        except Exception, e:
+            result.exception = e
+        finally:
+            result.seconds = time() - started
+            result.event.set()
+
+    def submit(self, link, userAgent, cookies):
+        result = SizeProbe(link, userAgent, cookies)
+        result.task = self.reactor.spawn(self.probe(result))
+        return result
+
+    def close(self):
+        pass # The reactor is closed by the crawler
+
+class ReactorListing(object):
+    '''Reads listing pages as reactor coroutines, in place of HTTPListing, prefetching the pages to be read next.'''
+    def __init__(self, reactor, userAgent = None, cookies = (), cache = None):
+        self.reactor = reactor
+        self.userAgent = userAgent
+        self.cookies = cookieHeader(cookies)
+        self.cache = cache
+        self.prefetched = {} # url => (task, result)
+
+    def read(self, url, result):
+        entry = self.cache.get(url) if self.cache else None
+        if entry and entry['fresh']:
+            result.append(ListingPage.fromCache(entry['data']))
+            return
+        transfer = yield Transfer('listing', url, self.userAgent, self.cookies, requestHeaders = PageCache.conditionalHeaders(entry))
+        if transfer.code == 304 and entry:
+            self.cache.revalidate(url)
+            result.append(ListingPage.fromCache(entry['data']))
+            return
+        transfer.check()
+        charset = transfer.headers.get('content-type', '').partition('charset=')[2].strip() or 'UTF-8'
+        page = ListingPage(transfer.effectiveURL, transfer.body, transfer.body.decode(charset, 'replace'))
+        if page.isVimeo and self.cache:
+            self.cache.put(url, page.cacheData(), transfer.headers.get('etag'), transfer.headers.get('last-modified'), entry is not None)
+        result.append(page)
+
+    def prefetch(self, url):
+        if url not in self.prefetched:
+            result = []
+            self.prefetched[url] = (self.reactor.spawn(self.read(url, result)), result)
+
+    def fetch(self, url):
+        '''Returns ListingPage, or None if the page can't be read without a browser.'''
+        self.prefetch(url)
+        (task, result) = self.prefetched.pop(url)
+        task.wait()
+        page = result[0]
+        return page if page.isVimeo else None
+
+def preallocate(f, offset, length, keepSize = False):
+    '''Reserves the disk space for the part of the file, so that it's written contiguously, returns True if done.
+
+    posix_fallocate() is not used, as it fills the space with zeros where the filesystem can't allocate it, e.g. over NFS.
+    '''
+    if not fallocate or length <= 0:
+        return False
+    return fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE if keepSize else 0, offset, length) == 0
+
+class FileWriter(object):
+    '''Writes a file through a large buffer, flushed in blocks aligned to the buffer size, from the specified position, truncating the file there if requested.
+
+    The data is forced to the disk according to the fsync policy: None to leave it to the OS,
+    'end' on close(), or a number of bytes to sync every time that much was written, and on close().
+    '''
+    BUFFER_SIZE = 4 * 1024 * 1024 # 4 megabytes
+
+    def __init__(self, fileName, position = 0, size = None, fsync = None, truncate = False):
+        self.file = open(fileName, 'r+b' if isfile(fileName) else 'wb', 0) # Unbuffered, the buffering is done here
+        if truncate:
+            self.file.truncate(position)
+        self.file.seek(position)
+        self.position = self.synced = position
+        self.fsync = fsync
+        self.parts = []
+        self.buffered = 0
+        self.written = 0
+        self.seconds = 0.0 # Spent writing and syncing
+        if size:
+            preallocate(self.file, position, size - position, True)
+
+    def tell(self):
+        return self.position + self.buffered
+
+    def write(self, data):
+        self.parts.append(data)
+        self.buffered += len(data)
+        end = (self.position + self.buffered) // self.BUFFER_SIZE * self.BUFFER_SIZE
+        if end > self.position:
+            data = ''.join(self.parts)
+            (data, rest) = (data[:end - self.position], data[end - self.position:])
+            (self.parts, self.buffered) = ([rest] if rest else [], len(rest))
+            self.writeData(data)
+
+    def writeData(self, data):
+        started = time()
+        self.file.write(data)
+        self.position += len(data)
+        self.written += len(data)
+        if self.fsync not in (None, 'end') and self.position - self.synced >= self.fsync:
+            fsync(self.file.fileno())
+            self.synced = self.position
+        self.seconds += time() - started
+
+    def flush(self):
+        '''Writes out the buffered data.'''
+        if self.parts:
+            data = ''.join(self.parts)
+            (self.parts, self.buffered) = ([], 0)
+            self.writeData(data)
+
+    def close(self):
+        try:
+            self.flush()
+            if self.fsync is not None and self.position > self.synced:
+                started = time()
+                fsync(self.file.fileno())
+                self.seconds += time() - started
+        finally:
+            self.file.close()
+
+class SegmentedDownload(object):
+    '''Downloads a file of known size as a number of byte ranges in parallel connections, into a preallocated file.
+
+    Progress of every segment is saved to a state file next to the target file,
+    so that an interrupted download resumes every segment from where it stopped.
+    '''
+    STATE_SUFFIX = '.segments'
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024 # 4 megabytes
+    CHUNK_SIZE = 256 * 1024 # 256 kilobytes
+    SAVE_QUANTUM = 4 * 1024 * 1024 # Save state after every 4 megabytes of a segment
+
+    def __init__(self, session, link, fileName, size, numSegments, timeout, cookies, bandwidth = None, fsync = None, progress = None, userAgent = None):
+        self.session = session
+        self.userAgent = userAgent # The cookies were issued to the browser with this user agent
+        self.fsync = fsync
+        self.progress = progress # TransferProgress
+        self.received = 0
+        self.written = 0 # Bytes written to the file
+        self.writeSeconds = 0.0
+        self.bandwidth = bandwidth
+        self.link = link
+        self.fileName = fileName
+        self.stateFileName = fileName + self.STATE_SUFFIX
+        self.size = size
+        self.timeout = timeout
+        self.cookies = cookies
+        self.lock = Lock()
+        self.segments = self.loadState()
+        if self.segments is None:
+            start = getFileSize(fileName) or 0 # A file started by a single stream download is complete up to its size
+            if start > size:
+                start = 0
+            numSegments = max(1, min(numSegments, (size - start) // self.MIN_SEGMENT_SIZE))
+            bounds = tuple(start + (size - start) * n // numSegments for n in xrange(numSegments + 1))
+            self.segments = [[bounds[n], bounds[n + 1], 0] for n in xrange(numSegments)] # [start, end, done]
+        with open(fileName, 'r+b' if isfile(fileName) else 'wb') as f:
+            f.truncate(size)
+            preallocate(f, 0, size)
+        self.saveState()
+        self.startSize = self.downloaded()
+
+    @classmethod
+    def isPending(cls, fileName):
+        '''Returns True if the file was preallocated by a segmented download that isn't complete yet.'''
+        return isfile(fileName + cls.STATE_SUFFIX)
+
+    @classmethod
+    def abandon(cls, fileName):
+        '''Truncates the file left by an interrupted segmented download to the part downloaded contiguously from its start,
+           and removes the state, so that a stream download can resume the file, returns True if there was such a download.
+        '''
+        stateFileName = fileName + cls.STATE_SUFFIX
+        if not isfile(stateFileName):
+            return False
+        try:
+            with open(stateFileName) as f:
+                segments = sorted(jsonLoad(f)['segments'])
+            size = segments[0][0] # The part before the first segment was complete when the segments were set up
+            for (start, end, done) in segments:
+                if start > size:
+                    break
+                size = start + done
+                if size < end:
+                    break
+        except Exception:
+            size = 0
+        if isfile(fileName):
+            with open(fileName, 'r+b') as f:
+                f.truncate(size)
+        remove(stateFileName)
+        return True
+
+    def loadState(self):
+        try:
+            with open(self.stateFileName) as f:
+                state = jsonLoad(f)
+            if state['size'] == self.size and getFileSize(self.fileName) == self.size:
+                return state['segments']
+        except Exception:
+            pass
+        return None
+
+    def saveState(self):
+        with self.lock:
+            with open(self.stateFileName, 'w') as f:
+                jsonDump({'size': self.size, 'segments': self.segments}, f)
+
+    def downloaded(self):
+        return self.size - sum(end - start - done for (start, end, done) in self.segments)
+
+    def downloadSegment(self, segment):
+        (start, end, done) = segment
+        if start + done >= end:
+            return
+        headers = {'Range': 'bytes=%d-%d' % (start + done, end - 1)}
+        if self.userAgent:
+            headers['User-Agent'] = self.userAgent
+        response = self.session.get(self.link, headers = headers, cookies = self.cookies, stream = True, timeout = self.timeout)
+        try:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError("Server doesn't support range requests")
+            f = FileWriter(self.fileName, start + done, fsync = self.fsync)
+            try:
+                saved = done
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    chunk = chunk[:end - f.tell()]
+                    f.write(chunk)
+                    if self.bandwidth:
+                        self.bandwidth.consume(len(chunk))
+                    if self.progress:
+                        with self.lock:
+                            self.received += len(chunk)
+                        self.progress.update(self.startSize + self.received)
+                    if f.tell() - start - saved >= self.SAVE_QUANTUM:
+                        f.flush()
+                        segment[2] = saved = f.tell() - start # Only the data written out is saved as done
+                        self.saveState()
+                    if f.tell() >= end:
+                        break
+            finally:
+                f.close()
+                segment[2] = f.tell() - start
+                with self.lock:
+                    self.written += f.written
+                    self.writeSeconds += f.seconds
+        finally:
+            response.close()
+            self.saveState()
+        if start + segment[2] < end:
+            raise IOError("Segment %d-%d ended prematurely at %d" % (start, end - 1, start + segment[2]))
+
+    def download(self, retryCount):
+        '''Downloads all the segments, retrying each on its own, returns the list of errors.'''
+        errors = []
+        def downloadSegmentWithRetries(segment):
+            for attempt in xrange(retryCount):
+                try:
+                    self.downloadSegment(segment)
+                    return
+                except Exception, e:
+                    if attempt == retryCount - 1:
+                        with self.lock:
+                            errors.append(e)
+        pool = WorkerPool(downloadSegmentWithRetries, len(self.segments), 'Segment')
+        for segment in self.segments:
+            pool.submit(segment)
+        pool.close()
+        if not errors:
+            try:
+                remove(self.stateFileName)
+            except OSError:
+                pass
+        return errors
+
+class StateDatabase(object):
+    '''Persistent per-video state stored in the target directory, keyed by vID.'''
+    FIELDS = ('quality', 'remoteSize', 'etag', 'lastModified', 'fileName', 'localSize', 'localMTime', 'verified', 'processed', 'sha256', 'sample', 'thumbnailETag')
+    TYPES = ('TEXT', 'INTEGER', 'TEXT', 'TEXT', 'TEXT', 'INTEGER', 'REAL', 'INTEGER', 'REAL', 'TEXT', 'TEXT', 'TEXT')
+
+    def __init__(self, fileName):
+        self.lock = Lock()
+        self.directory = dirname(fileName)
+        self.connection = connect(fileName, check_same_thread = False) # Access is serialized with the lock
+        self.connection.execute('CREATE TABLE IF NOT EXISTS videos (vID INTEGER PRIMARY KEY, %s)' % ', '.join('%s %s' % field for field in zip(self.FIELDS, self.TYPES)))
+        columns = set(row[1] for row in self.connection.execute('PRAGMA table_info(videos)'))
+        for (field, fieldType) in zip(self.FIELDS, self.TYPES):
+            if field not in columns: # Database created by an older version
+                self.connection.execute('ALTER TABLE videos ADD COLUMN %s %s' % (field, fieldType))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS videosContent ON videos (localSize, sha256)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS folders (url TEXT, vID INTEGER, PRIMARY KEY (url, vID))')
+        self.connection.commit()
+
+    def get(self, vID):
+        with self.lock:
+            row = self.connection.execute('SELECT %s FROM videos WHERE vID = ?' % ', '.join(self.FIELDS), (vID,)).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def update(self, vID, **fields):
+        assert all(field in self.FIELDS for field in fields)
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO videos (vID) VALUES (?)', (vID,))
+            if fields:
+                self.connection.execute('UPDATE videos SET %s WHERE vID = ?' % ', '.join('%s = ?' % field for field in fields), tuple(fields.itervalues()) + (vID,))
+            self.connection.commit()
+
+    def isCompleted(self, vID):
+        '''Returns True if the video file was completely downloaded.'''
+        with self.lock:
+            row = self.connection.execute('SELECT fileName, remoteSize, localSize FROM videos WHERE vID = ?', (vID,)).fetchone()
+        return bool(row and row[0] and row[1] and row[1] == row[2]) and not SegmentedDownload.isPending(encodeForFileSystem(join(self.directory, row[0])))
+
+    def findContent(self, size, vID, sha256 = None):
+        '''Returns (vID, fileName, localMTime, sha256, sample) of the other videos with files of the specified size and known content, with the specified hash if any.'''
+        (query, parameters) = ('SELECT vID, fileName, localMTime, sha256, sample FROM videos WHERE localSize = ? AND vID != ? AND sample IS NOT NULL', (size, vID))
+        if sha256:
+            (query, parameters) = (query + ' AND sha256 = ?', parameters + (sha256,))
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def getFolderVIDs(self, url):
+        '''Returns the set of vIDs found in the specified folder during the previous runs.'''
+        with self.lock:
+            return set(vID for (vID,) in self.connection.execute('SELECT vID FROM folders WHERE url = ?', (url,)))
+
+    def setFolderVIDs(self, url, vIDs, replace):
+        '''Saves the vIDs found in the specified folder, replace means the folder was read completely.'''
+        with self.lock:
+            if replace:
+                self.connection.execute('DELETE FROM folders WHERE url = ?', (url,))
+            self.connection.executemany('INSERT OR IGNORE INTO folders (url, vID) VALUES (?, ?)', ((url, vID) for vID in vIDs))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class PageCache(object):
+    '''Results parsed from listing and video pages, stored in the target directory, keyed by URL.
+
+    Pages fetched within the TTL are used without a request, older listing pages are revalidated with conditional requests.
+    '''
+    def __init__(self, fileName, ttl, maxSize, maxAge):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.stats = dict.fromkeys(('hits', 'revalidated', 'expired', 'misses'), 0)
+        self.lock = Lock()
+        self.connection = connect(fileName, check_same_thread = False) # Access is serialized with the lock
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, lastModified TEXT, fetched REAL, used REAL, data TEXT)')
+        self.connection.commit()
+        self.evict()
+
+    def count(self, kind):
+        with self.lock:
+            self.stats[kind] += 1
+
+    def get(self, url):
+        '''Returns dict with the data, etag, lastModified and fresh fields for the cached page, or None.'''
+        with self.lock:
+            row = self.connection.execute('SELECT data, etag, lastModified, fetched FROM pages WHERE url = ?', (url,)).fetchone()
+            if row: # Committed with the next page saved, losing it is harmless
+                self.connection.execute('UPDATE pages SET used = ? WHERE url = ?', (time(), url))
+        entry = {'data': jsonLoads(row[0]), 'etag': row[1], 'lastModified': row[2], 'fresh': time() < row[3] + self.ttl} if row else None
+        if not entry or entry['fresh']:
+            self.count('hits' if entry else 'misses')
+        return entry
+
+    @staticmethod
+    def conditionalHeaders(entry):
+        '''Returns the headers that make a request for the cached page return 304 if the page hasn't changed.'''
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = str(entry['etag'])
+        if entry and entry['lastModified']:
+            headers['If-Modified-Since'] = str(entry['lastModified'])
+        return headers
+
+    def put(self, url, data, etag = None, lastModified = None, expired = False):
+        '''Saves the page data, expired means the page was cached before and was fetched again.'''
+        if expired: # Misses are counted by get()
+            self.count('expired')
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO pages (url, etag, lastModified, fetched, used, data) VALUES (?, ?, ?, ?, ?, ?)', (url, etag, lastModified, time(), time(), jsonDumps(data, separators = (',', ':'))))
+            self.connection.commit()
+
+    def revalidate(self, url):
+        '''Marks the cached page as just fetched, after the server has reported it unchanged.'''
+        self.count('revalidated')
+        with self.lock:
+            self.connection.execute('UPDATE pages SET fetched = ? WHERE url = ?', (time(), url))
+
+    def remove(self, url):
+        with self.lock:
+            self.connection.execute('DELETE FROM pages WHERE url = ?', (url,))
+            self.connection.commit()
+
+    def evict(self):
+        '''Removes the pages not used for longer than the maximum age, then the least recently used ones, until the cache fits in the maximum size.'''
+        with self.lock:
+            self.connection.execute('DELETE FROM pages WHERE used < ?', (time() - self.maxAge,))
+            size = self.connection.execute('SELECT SUM(LENGTH(data)) FROM pages').fetchone()[0] or 0
+            if size > self.maxSize:
+                urls = []
+                for (url, pageSize) in self.connection.execute('SELECT url, LENGTH(data) FROM pages ORDER BY used'):
+                    if size <= self.maxSize:
+                        break
+                    urls.append((url,))
+                    size -= pageSize
+                self.connection.executemany('DELETE FROM pages WHERE url = ?', urls)
+            self.connection.commit()
+
+    def hitRate(self):
+        '''Returns the share of the pages served from the cache, either fresh or revalidated, or None if the cache was not used.'''
+        total = sum(self.stats.itervalues())
+        return float(self.stats['hits'] + self.stats['revalidated']) / total if total else None
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.connection.close()
+
+class ListingPage(object):
+    '''Links, next page link and title extracted from a listing page without a browser.'''
+    CACHED_FIELDS = ('url', 'links', 'nextLink', 'title', 'isVimeo')
+
+    def __init__(self, url, html, text):
+        self.url = url
+        self.links = []
+        self.nextLink = None
+        self.title = None
+        self.isVimeo = False
+        if parseHTML:
+            self.parseWithLXML(html)
+        else:
+            parser = ListingParser()
+            parser.feed(text)
+            parser.close()
+            self.links = parser.links
+            self.nextLink = parser.nextLink
+            self.title = parser.title()
+            self.isVimeo = parser.isVimeo
+        self.links = [urljoin(url, link) for link in self.links]
+        if self.nextLink:
+            self.nextLink = urljoin(url, self.nextLink)
+
+    def cacheData(self):
+        return dict((field, getattr(self, field)) for field in self.CACHED_FIELDS)
+
+    @classmethod
+    def fromCache(cls, data):
+        '''Returns ListingPage with the fields saved in the page cache, without parsing.'''
+        page = cls.__new__(cls)
+        for field in cls.CACHED_FIELDS:
+            setattr(page, field, data[field])
+        return page
+
+    @staticmethod
+    def classXPath(className):
+        return 'contains(concat(" ", normalize-space(@class), " "), " %s ")' % className
+
+    def parseWithLXML(self, html):
+        root = parseHTML(html)
+        self.isVimeo = bool(root.xpath('//*[@id="topnav_desktop"]'))
+        self.links = root.xpath('//*[@id="browse_content"]//*[%s]//a/@href' % self.classXPath('browse'))
+        self.nextLink = (root.xpath('//*[%s]//a[@rel="next"]/@href' % self.classXPath('pagination')) or (None,))[0]
+        for (xpath, getter) in (('//*[@id="page_header"]//h1//a', lambda e: e.text_content()), # https://vimeo.com/channels/*/videos
+                                ('//*[@id="page_header"]//h1', lambda e: e.text_content()), # https://vimeo.com/album/*
+                                ('//*[@id="group_header"]//h1//a', lambda e: e.get('title')), # https://vimeo.com/groups/*/videos
+                                ('//*[@id="group_header"]//h1//a', lambda e: e.text_content())): # backup
+            elements = root.xpath(xpath)
+            title = ' '.join((getter(elements[0]) or '').split()) if elements else None
+            if title:
+                self.title = title
+                break
+
+class ListingParser(HTMLParser):
+    '''Extracts listing page data with the standard library parser, used if lxml is not available.'''
+    VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'))
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.stack = [] # (tag, id, classes) of currently open elements
+        self.links = []
+        self.nextLink = None
+        self.isVimeo = False
+        self.titles = [None] * 4 # Candidates in the order of preference, as in ListingPage.parseWithLXML()
+        self.captures = [] # (titles index, stack depth, text parts) of elements which text is being collected
+
+    def inside(self, elementID = None, className = None, tag = None):
+        return any((elementID is None or eID == elementID) and (className is None or className in classes) and (tag is None or t == tag) for (t, eID, classes) in self.stack)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        elementID = attrs.get('id')
+        if elementID == 'topnav_desktop':
+            self.isVimeo = True
+        if tag == 'a':
+            href = attrs.get('href')
+            if href and self.inside('browse_content') and self.inside(className = 'browse'):
+                self.links.append(href)
+            if href and attrs.get('rel') == 'next' and self.inside(className = 'pagination') and not self.nextLink:
+                self.nextLink = href
+            if self.inside(tag = 'h1') and self.inside('page_header') and self.titles[0] is None:
+                self.captures.append((0, len(self.stack), []))
+            if self.inside(tag = 'h1') and self.inside('group_header'):
+                if self.titles[2] is None:
+                    self.titles[2] = attrs.get('title') or ''
+                if self.titles[3] is None:
+                    self.captures.append((3, len(self.stack), []))
+        elif tag == 'h1' and self.inside('page_header') and self.titles[1] is None:
+            self.captures.append((1, len(self.stack), []))
+        if tag not in self.VOID_TAGS:
+            self.stack.append((tag, elementID, (attrs.get('class') or '').split()))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if not any(t == tag for (t, _elementID, _classes) in self.stack):
+            return # Stray closing tag
+        while self.stack:
+            if self.stack.pop()[0] == tag:
+                break
+        for capture in tuple(self.captures):
+            (index, depth, parts) = capture
+            if depth >= len(self.stack):
+                self.captures.remove(capture)
+                if self.titles[index] is None:
+                    self.titles[index] = ''.join(parts)
+
+    def handle_data(self, data):
+        for (_index, _depth, parts) in self.captures:
+            parts.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+    def title(self):
+        for title in self.titles:
+            title = ' '.join((title or '').split())
+            if title:
+                return title
+        return None
+
+class HTTPListing(object):
+    '''Reads listing pages over a pooled HTTP session that shares the browser user agent and cookies.'''
+    def __init__(self, timeout, retryCount, userAgent = None, cookies = (), cache = None):
+        self.timeout = timeout
+        self.cache = cache
+        self.session = createSession(1, retryCount)
+        if userAgent:
+            self.session.headers['User-Agent'] = userAgent
+        for cookie in cookies:
+            self.session.cookies.set(str(cookie['name']), str(cookie['value']), domain = cookie.get('domain'), path = cookie.get('path', '/'))
+
+    def fetch(self, url):
+        '''Returns ListingPage, or None if the page can't be read without a browser.'''
+        entry = self.cache.get(url) if self.cache else None
+        if entry and entry['fresh']:
+            return ListingPage.fromCache(entry['data'])
+        response = self.session.get(url, timeout = self.timeout, headers = PageCache.conditionalHeaders(entry))
+        if response.status_code == 304 and entry:
+            self.cache.revalidate(url)
+            return ListingPage.fromCache(entry['data'])
+        response.raise_for_status()
+        page = ListingPage(response.url, response.content, response.text)
+        if page.isVimeo and self.cache:
+            self.cache.put(url, page.cacheData(), response.headers.get('etag'), response.headers.get('last-modified'), entry is not None)
+        return page if page.isVimeo else None
+
+class VimeoAPI(object):
+    '''Reads Vimeo API resources over a pooled HTTP session authorized with a personal access token.'''
+    PAGE_SIZE = 100 # Maximum allowed by the API
+    FIELDS = 'uri,name,link,description,user.name,privacy.view,download,pictures.sizes,metadata.connections.videos.uri' # Fields of videos and folders used by the crawler
+    FOLDER_FIELDS = 'uri,name,link,metadata.connections.videos.uri'
+    USER_AGENT = TITLE.split(' (c)')[0]
+    EXPIRY_MARGIN = 600 # Download links expiring sooner than this number of seconds are read again
+
+    def __init__(self, baseURL, token, timeout, retryCount):
+        self.baseURL = baseURL.rstrip('/')
+        self.timeout = timeout
+        self.retryCount = retryCount
+        self.session = createSession(1, retryCount)
+        self.session.headers.update({'Authorization': 'bearer %s' % token, 'Accept': 'application/vnd.vimeo.*+json;version=3.4', 'User-Agent': self.USER_AGENT})
+
+    def get(self, path, **params):
+        '''Returns the JSON resource at the path, waiting and retrying if the rate limit is exceeded.'''
+        for attempt in xrange(self.retryCount + 1):
+            response = self.session.get(self.baseURL + path, params = params, timeout = self.timeout)
+            if response.status_code != 429 or attempt == self.retryCount:
+                break
+            sleep(float(response.headers.get('retry-after') or 60))
+        response.raise_for_status()
+        return response.json()
+
+    def getPage(self, path):
+        '''Returns the resources on a page of the paginated collection and the path of the next page, or None.'''
+        url = urlparse(path)
+        result = self.get(url.path, **dict((('per_page', self.PAGE_SIZE), ('fields', self.FIELDS)) + tuple(parse_qsl(url.query))))
+        return (result.get('data') or (), (result.get('paging') or {}).get('next'))
+
+    @staticmethod
+    def getVID(resource):
+        '''Returns vID if the resource is a video, None otherwise.'''
+        tokens = (resource.get('uri') or '').split('/')
+        return int(tokens[2]) if len(tokens) == 3 and tokens[1] == 'videos' and tokens[2].isdigit() else None
+
+    @staticmethod
+    def getVideosPath(folder):
+        '''Returns the path of the videos collection of the folder resource, as provided by the API, or None.'''
+        return (((folder.get('metadata') or {}).get('connections') or {}).get('videos') or {}).get('uri')
+
+    @classmethod
+    def isExpired(cls, video):
+        '''Returns True if the download links of the video resource expire soon.'''
+        return any(timegm(strptime(download['expires'][:19], '%Y-%m-%dT%H:%M:%S')) < time() + cls.EXPIRY_MARGIN for download in video.get('download') or () if download.get('expires'))
+
+    @staticmethod
+    def downloadLabel(download):
+        return 'Original' if download.get('quality') == 'source' else download.get('rendition') or download.get('public_name') or str(download.get('quality') or '').upper()
+
+    @classmethod
+    def chooseDownload(cls, downloads):
+        '''Returns (label, download) of the download link preferred according to FILE_PREFERENCES, or the largest one, or (None, None).'''
+        labeled = tuple((cls.downloadLabel(download), download) for download in downloads if download.get('link'))
+        for preference in FILE_PREFERENCES:
+            for exact in (True, False):
+                for (label, download) in labeled:
+                    if label == preference if exact else preference in label:
+                        return (label, download)
+        return max(labeled, key = lambda (label, download): download.get('size') or 0) if labeled else (None, None)
+
 class VimeoCrawler(object):
     def __init__(self, args):
         # Simple options
         self.verbose = False
         self.updateOnly = False
         self.doDownload = True
-        self.getFileSizes = bool(requests)
+        self.getFileSizes = True
         self.useHardLinks = False
+        self.deduplicate = False
+        self.precheckDuplicates = False
         self.saveThumbnails= False
         self.saveDetails = False
         self.verifyContent = False
         self.verifyExisting = False
+        self.verifyOnly = False
+        self.reverify = False
         self.detectObsolete = False
+        self.revisit = False
+        self.resume = False
         # Selenium WebDriver settings
+        self.driverLocal = local() # Every thread works with its own browser session
+        self.drivers = []
         self.driver = None
         self.driverName = 'Firefox'
         self.driverClass = None
+        self.browsers = 1
+        self.remoteURL = None
+        self.backend = 'browser'
+        self.listing = None
+        self.apiToken = None
+        self.apiURL = VIMEO_API_URL
+        self.api = None
+        self.apiVideos = {} # vID => video resource read with the listing
+        self.apiFolders = {} # Folder URL => folder resource read with the listing
+        self.engine = 'threads'
+        self.transport = None
+        self.reactor = None
+        self.graphComplete = False # All the folders were read to the end, so the links to the videos not found in them are stale
+        self.videoFiles = {} # vID => unicode (video, thumbnail, details) file names of the videos processed during the run
+        self.downloadSlots = None
         # Options with parameters
         self.credentials = None
         self.targetDirectory = '.'
@@ -274,13 +2078,37 @@ class VimeoCrawler(object):
         self.timeout = 3
         self.retryCount = 3
         self.pause = None
+        self.rateLimit = None
+        self.pageRate = None
+        self.bandwidth = None
+        self.pacer = None
+        self.metricsFileName = None
+        self.prometheusFileName = None
+        self.cacheTTL = None
+        self.cacheSize = '64M'
+        self.cacheAge = 30
+        self.pageCache = None
+        self.jobs = 1
+        self.probes = 1
+        self.segments = 1
+        self.fsync = 'never'
         self.maxItems = None
         self.setLanguage = None
         self.setPreset = None
         # Startup defaults
         self.startURL = None
         self.errors = 0
+        self.errorsLock = Lock()
+        self.downloadPool = None
+        self.sizeProber = None
+        self.thumbnailPool = None
+        self.thumbnailSession = None
+        self.segmentSession = None
+        self.sampleSession = None
+        self.verifyPool = None
+        self.stateDatabase = None
         self.vIDs = []
+        self.graph = CrawlGraph()
         try:
             # Reading command line options
             (options, parameters) = getopt(args, SHORT_OPTIONS, LONG_OPTIONS)
@@ -299,31 +2127,67 @@ class VimeoCrawler(object):
                     self.verifyContent = True
                 elif option in ('-x', '--verify-existing'):
                     self.verifyExisting = True
+                elif option in ('--verify-only',):
+                    self.verifyOnly = self.verifyExisting = True
+                elif option in ('--reverify',):
+                    self.reverify = self.verifyExisting = True
                 elif option in ('-o', '--detect-obsolete'):
                     self.detectObsolete = True
                 elif option in ('--hard-links',):
                     self.useHardLinks = True
+                elif option in ('--deduplicate',):
+                    self.deduplicate = True
+                elif option in ('--precheck-duplicates',):
+                    self.precheckDuplicates = self.deduplicate = True
                 elif option in ('--thumbnails',):
                     self.saveThumbnails= True
                 elif option in ('--details',):
                     self.saveDetails = True
+                elif option in ('--revisit',):
+                    self.revisit = True
+                elif option in ('--resume',):
+                    self.resume = True
                 else: # Parsing options with arguments
                     index = None
+                    optionNames = OPTION_NAMES + LONG_OPTION_NAMES
                     for (maskNum, pattern) in enumerate(OPTION_PATTERNS):
                         m = pattern.match(option)
                         if not m:
                             continue
-                        index = tuple(OPTION_NAMES.index(option) for option in OPTION_NAMES if (option if maskNum else option[0]) == m.group(1))
+                        index = tuple(optionNames.index(option) for option in (optionNames if maskNum else OPTION_NAMES) if (option if maskNum else option[0]) == m.group(1))
                         break
                     else:
                         assert False # This should never happen
                     assert len(index) == 1
-                    setattr(self, FIELD_NAMES[index[0]], value)
+                    setattr(self, (FIELD_NAMES + LONG_FIELD_NAMES)[index[0]], value)
             # Processing command line options
             driverTuple = DRIVERS.get(self.driverName.lower())
             if not driverTuple:
                 raise ValueError("Unknown driver %s, valid values are: %s" % (self.driverName, '/'.join(sorted(x[0] for x in DRIVERS.itervalues()))))
             (self.driverName, self.driverClass) = driverTuple
+            self.backend = self.backend.lower()
+            if self.backend not in BACKENDS:
+                raise ValueError("Unknown backend %s, valid values are: %s" % (self.backend, '/'.join(BACKENDS)))
+            self.engine = self.engine.lower()
+            if self.engine not in ENGINES:
+                raise ValueError("Unknown engine %s, valid values are: %s" % (self.engine, '/'.join(ENGINES)))
+            if self.backend == 'http' and not requests and self.engine != 'reactor':
+                raise ValueError("http backend requires Requests library, or the reactor engine")
+            if not requests and self.engine != 'reactor':
+                self.getFileSizes = False
+            if self.backend == 'api':
+                if not requests:
+                    raise ValueError("api backend requires Requests library")
+                if not self.apiToken:
+                    raise ValueError("api backend requires --token parameter")
+                if self.credentials:
+                    raise ValueError("api backend uses --token instead of -l / --login parameter")
+            elif self.apiToken:
+                raise ValueError("--token parameter is only used by the api backend")
+            if self.deduplicate and not hardlink:
+                raise ValueError("--deduplicate requires filesystem hard links")
+            if self.precheckDuplicates and not requests:
+                raise ValueError("--precheck-duplicates requires Requests library")
             if self.credentials:
                 try:
                     index = self.credentials.index(':', self.credentials.index('@'))
@@ -352,11 +2216,82 @@ class VimeoCrawler(object):
             except ValueError:
                 raise ValueError("-r / --retries parameter must be a non-negative integer")
             try:
-                self.pause = int(self.pause or 0)
-                if self.pause < 0:
+                self.pause = int(self.pause or 0)
+                if self.pause < 0:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("-p / --pause parameter must be a non-negative integer")
+            if self.rateLimit:
+                try:
+                    self.bandwidth = TokenBucket(parseSize(self.rateLimit))
+                except (ValueError, ZeroDivisionError):
+                    raise ValueError("--rate-limit parameter must be a positive size, like 500K or 2M")
+            if self.pageRate:
+                try:
+                    self.pageRate = float(self.pageRate)
+                    if self.pageRate <= 0:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("--page-rate parameter must be a positive number")
+            self.pacer = NavigationPacer(self.pageRate)
+            if self.cacheTTL is not None:
+                try:
+                    self.cacheTTL = int(self.cacheTTL)
+                    if self.cacheTTL < 0:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("--cache-ttl parameter must be a non-negative integer")
+                try:
+                    self.cacheSize = parseSize(self.cacheSize)
+                    if self.cacheSize <= 0:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("--cache-size parameter must be a positive size, like 500K or 64M")
+                try:
+                    self.cacheAge = float(self.cacheAge)
+                    if self.cacheAge <= 0:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("--cache-age parameter must be a positive number")
+            try:
+                self.jobs = int(self.jobs)
+                if self.jobs < 1:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("-j / --jobs parameter must be a positive integer")
+            try:
+                self.probes = int(self.probes)
+                if self.probes < 1:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("--probes parameter must be a positive integer")
+            try:
+                self.segments = int(self.segments)
+                if self.segments < 1:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("--segments parameter must be a positive integer")
+            if self.segments > 1 and not requests:
+                raise ValueError("--segments parameter requires Requests library")
+            if self.segments > 1 and self.engine == 'reactor':
+                raise ValueError("--segments parameter is not supported by the reactor engine")
+            if self.fsync.lower() in FSYNC_POLICIES:
+                self.fsync = None if self.fsync.lower() == 'never' else 'end'
+            else:
+                try:
+                    self.fsync = parseSize(self.fsync)
+                    if self.fsync <= 0:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("--fsync parameter must be %s or a positive size, like 64M" % ' or '.join(FSYNC_POLICIES))
+            try:
+                self.browsers = int(self.browsers)
+                if self.browsers < 1:
                     raise ValueError
             except ValueError:
-                raise ValueError("-p / --pause parameter must be a non-negative integer")
+                raise ValueError("--browsers parameter must be a positive integer")
+            if self.browsers > 1 and self.backend == 'api':
+                raise ValueError("--browsers parameter is not used by the api backend")
             if self.setLanguage:
                 self.setLanguage = self.setLanguage.capitalize()
             if parameters:
@@ -364,27 +2299,44 @@ class VimeoCrawler(object):
                     for vID in (URL(p).vID for p in parameters):
                         if vID is None: # At least one parameter is not video
                             raise ValueError
-                        if vID not in self.vIDs:
-                            self.vIDs.append(vID) # Remove duplicates
+                        self.graph.addVideo(vID) # Removes duplicates
+                    self.vIDs = list(self.graph.vIDs)
                     self.detectObsolete = False
                 except ValueError:
                     if len(parameters) == 1:
                         self.startURL = URL(parameters[0])
                     else:
                         raise ValueError("If multiple parameters are specified, they must all be videos")
-            elif self.credentials:
+            elif self.credentials or self.apiToken:
                 self.vIDs = []
-            else:
-                raise ValueError("Neither login credentials nor start URL is specified")
+            elif not self.verifyOnly:
+                raise ValueError("Neither login credentials, nor API token, nor start URL is specified")
+            if self.verifyOnly:
+                self.detectObsolete = False
             # Creating target directory
             self.createDir()
             if self.startURL:
                 self.startURL.createFile(self.targetDirectory)
+            self.stateDatabase = StateDatabase(join(self.targetDirectory, STATE_FILE_NAME))
+            if self.cacheTTL is not None:
+                self.pageCache = PageCache(join(self.targetDirectory, CACHE_FILE_NAME), self.cacheTTL, self.cacheSize, self.cacheAge * 24 * 3600)
+            self.inventory = Inventory(self.targetDirectory)
+            self.journal = CrawlJournal(join(self.targetDirectory, JOURNAL_FILE_NAME), self.resume)
+            self.metrics = Metrics(self.prometheusFileName)
             # Configuring logging
+            progressDisplay = self.progressDisplay = ProgressDisplay(stdout, getLogger('vimeo'), stdout.isatty() and not isWindows)
             rootLogger = getLogger()
             if not rootLogger.handlers:
-                formatter = Formatter("%(asctime)s %(levelname)7s %(message)s", '%Y-%m-%d %H:%M:%S')
-                streamHandler = StreamHandler()
+                formatter = Formatter("%(asctime)s %(levelname)7s " + ("%(threadName)s " if self.jobs > 1 or self.browsers > 1 or self.verifyContent or self.verifyExisting else '') + "%(message)s", '%Y-%m-%d %H:%M:%S')
+                class ProgressStreamHandler(StreamHandler):
+                    def emit(self, record):
+                        if not progressDisplay.interactive:
+                            StreamHandler.emit(self, record)
+                            return
+                        with progressDisplay.lock: # The progress lines are erased, to be redrawn under the record
+                            progressDisplay.clear()
+                            StreamHandler.emit(self, record)
+                streamHandler = ProgressStreamHandler()
                 streamHandler.setFormatter(formatter)
                 fileHandler = FileHandler(join(self.targetDirectory, LOG_FILE_NAME))
                 fileHandler.setFormatter(formatter)
@@ -396,11 +2348,12 @@ class VimeoCrawler(object):
                 class OperationFilter(Filter):
                     def __init__(self):
                         Filter.__init__(self) # pylint: disable=W0233
-                        self.operation = None
+                        self.local = local() # Every thread has its own current operation
                         self.previousOperation = None
                     def filter(self, record):
-                        record.operation = ('%s\n' % self.operation) if self.operation != self.previousOperation else ''
-                        self.previousOperation = self.operation
+                        operation = getattr(self.local, 'operation', None)
+                        record.operation = ('%s\n' % operation) if operation != self.previousOperation else ''
+                        self.previousOperation = operation
                         return True
                 self.operationFilter = OperationFilter()
                 self.errorHandler.addFilter(self.operationFilter)
@@ -418,12 +2371,52 @@ class VimeoCrawler(object):
                 subprocess.communicate()
                 if subprocess.returncode not in (0, 1):
                     self.error("ffmpeg check FAILED (code %d), content verification NOT enabled", subprocess.returncode)
-                    self.verifyContent = self.verifyExisting = False
+                    self.verifyContent = self.verifyExisting = self.verifyOnly = self.reverify = False
                 else:
                     self.logger.debug("OK")
         except Exception, e:
             usage("ERROR: %s" % e)
 
+    @property
+    def driver(self):
+        return getattr(self.driverLocal, 'driver', None)
+
+    @driver.setter
+    def driver(self, driver):
+        self.driverLocal.driver = driver
+        self.driverLocal.browserState = None
+
+    def getBrowserState(self):
+        '''Returns the user agent and cookies of the browser session, they are read from the browser once per session and after login.'''
+        browserState = getattr(self.driverLocal, 'browserState', None)
+        if not browserState:
+            browserState = self.driverLocal.browserState = (str(self.driver.execute_script('return window.navigator.userAgent')), self.driver.get_cookies())
+        return browserState
+
+    def startDriver(self):
+        '''Starts a new browser session, locally or at the remote Selenium server, for the current thread.'''
+        self.logger.info("Starting %s%s...", self.driverName, (' at %s' % self.remoteURL) if self.remoteURL else '')
+        if self.remoteURL:
+            capabilities = getattr(getattr(webdriver, 'DesiredCapabilities', None), self.driverName.upper(), {})
+            self.driver = webdriver.Remote(command_executor = self.remoteURL, desired_capabilities = capabilities)
+        else:
+            self.driver = self.driverClass() # ToDo: Provide parameters to the driver
+        with self.errorsLock:
+            self.drivers.append(self.driver)
+        return self.driver
+
+    def closeDriver(self):
+        '''Closes the browser session of the current thread.'''
+        driver = self.driver
+        self.driver = None
+        if driver:
+            with self.errorsLock:
+                self.drivers.remove(driver)
+            try:
+                driver.quit() # Ends the session, close() would only close the window, leaving remote sessions and driver processes running
+            except Exception, e:
+                self.logger.warning("Error closing browser session: %s", e)
+
     def dumpPage(self):
         (f, dumpFileName) = mkstemp('.html', 'Error_', self.targetDirectory)
         close(f)
@@ -432,10 +2425,12 @@ class VimeoCrawler(object):
         self.logger.info("Page dumped as %s", dumpFileName)
 
     def setOperation(self, operation):
-        self.operationFilter.operation = operation
+        self.operationFilter.local.operation = operation
 
     def error(self, *args, **kwargs):
-        self.errors += 1
+        with self.errorsLock:
+            self.errors += 1
+        self.metrics.count('errors')
         self.logger.error(*args, **kwargs)
 
     def createDir(self, dirName = None):
@@ -449,31 +2444,63 @@ class VimeoCrawler(object):
         url = URL(url)
         self.logger.debug("Going to %s", url)
         self.setOperation(str(url))
+        self.paceNavigation()
+        self.metrics.count('pages')
+        started = time()
         self.driver.get(url.url)
         try:
             self.getElement("#topnav_desktop") # Detect if this is a Vimeo page
+            self.pacer.success()
         except NoSuchElementException:
             try: # Trying to overcome Google reCAPTCHA. To test, use self.driver.get('http://www.google.com/recaptcha/api2/demo')
                 self.getElement(".g-recaptcha")
-                self.driver.switch_to_frame(self.getElement('iframe'))
-                checkMark = self.getElement('.recaptcha-checkbox-checkmark')
-                checkMark.click()
-                self.driver.switch_to_default_content()
-                first = True
-                while True:
-                    try:
-                        self.getElement("#topnav_desktop") # Detect if this is a Vimeo page
-                        break
-                    except NoSuchElementException:
-                        if first:
-                            self.logger.info("Hit reCAPTCHA, user input required")
-                            first = False
+                self.slowDown("Hit reCAPTCHA")
+                self.pacer.block() # The other browsers wait until it's solved
+                try:
+                    self.driver.switch_to_frame(self.getElement('iframe'))
+                    checkMark = self.getElement('.recaptcha-checkbox-checkmark')
+                    checkMark.click()
+                    self.driver.switch_to_default_content()
+                    self.waitForVimeoPage()
+                finally:
+                    self.pacer.unblock()
             except NoSuchElementException:
                 self.error("Unindentified page, retrying")
                 self.dumpPage()
+                self.slowDown("Unidentified page")
+                self.paceNavigation()
                 self.driver.get(url.url)
+        self.metrics.observe('navigation', time() - started)
+
+    def waitForVimeoPage(self):
+        '''Waits for the captcha to be passed, without polling WebDriver more often than twice a second.'''
+        condition = presence_of_element_located((By.CSS_SELECTOR, "#topnav_desktop"))
+        try:
+            WebDriverWait(self.driver, self.timeout).until(condition) # The checkbox click alone may be enough
+        except TimeoutException:
+            self.logger.info("Hit reCAPTCHA, user input required")
+            while True:
+                try:
+                    WebDriverWait(self.driver, 60).until(condition)
+                    break
+                except TimeoutException:
+                    pass
+
+    def slowDown(self, reason):
+        rate = self.pacer.backoff()
+        self.metrics.count('backoffs')
+        self.logger.warning("%s, navigation rate lowered to %.1f pages per minute", reason, rate)
+
+    def paceNavigation(self):
+        delay = self.pacer.wait()
+        if delay >= 0.1:
+            self.logger.debug("Paced navigation for %.1f seconds", delay)
 
     def getElement(self, selector, wait = False, multiple = False):
+        with self.metrics.timer('elementWait' if wait else 'element'):
+            return self.findElement(selector, wait, multiple)
+
+    def findElement(self, selector, wait, multiple):
         isXpath = selector.startswith('//')
         if wait:
             try:
@@ -510,17 +2537,45 @@ class VimeoCrawler(object):
             welcomeLink.click()
             self.getElement('#content')
             self.loggedIn = True
+            self.driverLocal.browserState = None # The session cookies are set by the login
             self.userName = userName
+            return True
         except NoSuchElementException, e:
             self.error("Login failed: %s", e)
             self.dumpPage()
+            return False
+
+    def fetchListing(self, url):
+        '''Returns ListingPage read by the HTTP backend, or None if the browser is to be used for this page.'''
+        if not self.listing:
+            return None
+        url = str(url)
+        self.logger.debug("Fetching %s", url)
+        self.setOperation(url)
+        try:
+            self.paceNavigation()
+            self.metrics.count('pages')
+            with self.metrics.timer('listingFetch'):
+                page = self.listing.fetch(url)
+            if page:
+                self.pacer.success()
+            else:
+                self.logger.debug("Page requires the browser")
+            return page
+        except Exception, e:
+            self.logger.warning("Error fetching %s, using the browser: %s", url, e)
+            return None
 
-    def getItemsFromPage(self):
-        self.logger.debug("Processing %s", self.driver.current_url)
-        self.setOperation(self.driver.current_url)
+    def getItemsFromPage(self, page = None):
+        currentURL = page.url if page else self.driver.current_url
+        self.logger.debug("Processing %s", currentURL)
+        self.setOperation(currentURL)
         try:
-            links = self.getElements('#browse_content .browse a')
-            links = (link.get_attribute('href') for link in links)
+            if page:
+                links = page.links
+            else:
+                links = self.getElements('#browse_content .browse a')
+                links = (link.get_attribute('href') for link in links)
             items = tuple(URL(link) for link in links if VIMEO in link and not link.endswith('settings'))[:self.maxItems]
         except NoSuchElementException, e:
             self.error(e.msg)
@@ -537,17 +2592,44 @@ class VimeoCrawler(object):
         assert len(items) == len(set(items))
         return items
 
-    def getItemsFromFolder(self):
-        items = []
+    def isKnownPage(self, items, knownVIDs):
+        '''Returns True if all the items are videos known to belong to the folder and completely downloaded.'''
+        return items and all(item.isVideo and item.vID in knownVIDs and self.stateDatabase.isCompleted(item.vID) for item in items)
+
+    def getItemsFromFolder(self, page = None, url = None, items = ()):
+        items = [URL(item) for item in items] # Items of the pages read before the crawl was resumed
         numPages = 0
+        folderKey = str(url) if url else None
+        knownVIDs = self.stateDatabase.getFolderVIDs(folderKey) if folderKey else set()
+        stoppedEarly = False
         for _ in xrange(self.maxItems) if self.maxItems is not None else count():
-            items.extend(self.getItemsFromPage())
+            pageItems = list(self.getItemsFromPage(page))
             numPages += 1
-            try:
-                nextButton = self.getElement('.pagination a[rel=next]')
-                nextButton.click()
-            except NoSuchElementException:
+            nextLink = None
+            if self.updateOnly and self.isKnownPage(pageItems, knownVIDs):
+                # Listings are sorted newest first, so the rest of the folder is known from the previous runs
+                self.logger.debug("Page contains only known videos, skipping the rest of the folder")
+                foundVIDs = set(item.vID for item in items + pageItems if item.isVideo)
+                pageItems.extend(URL(vID) for vID in sorted(knownVIDs - foundVIDs, reverse = True))
+                stoppedEarly = True
+            elif page:
+                nextLink = page.nextLink
+            else:
+                try:
+                    nextButton = self.getElement('.pagination a[rel=next]')
+                    nextLink = nextButton.get_attribute('href')
+                except NoSuchElementException:
+                    pass
+            items.extend(pageItems)
+            self.journal.write(page = [journalItem(item) for item in pageItems], next = nextLink)
+            if not nextLink:
                 break
+            if page:
+                page = self.fetchListing(nextLink)
+                if not page:
+                    self.goTo(nextLink)
+            else:
+                nextButton.click()
         items = tuple(items)
         s = set()
         for item in items:
@@ -555,68 +2637,251 @@ class VimeoCrawler(object):
             s.add(item)
         if numPages > 1:
             self.logger.debug("Got total of %d items", len(items))
+        if folderKey:
+            self.stateDatabase.setFolderVIDs(folderKey, tuple(item.vID for item in items if item.isVideo), not stoppedEarly)
         return items
 
-    def getItemsFromURL(self, url = None, target = None):
+    def getItemsFromURL(self, url = None):
+        '''Crawls the URL and everything found under it, depth first, journaling the crawl so that it could be resumed.'''
         url = URL(url or self.driver.current_url)
         if not self.startURL:
             self.startURL = url
             self.startURL.createFile(self.targetDirectory)
-        items = ()
+        self.frontier = [(url.url, None, None)]
+        self.journal.write(start = url.url)
+        self.walkFrontier()
+
+    def walkFrontier(self):
+        '''Expands the URLs in the frontier until it's empty, the frontier is a stack of (url, folder number, resume state).'''
+        while self.frontier:
+            if hasattr(self.listing, 'prefetch') and not self.pacer.limited: # Prefetching would go around the page rate limit
+                for (nextURL, _folder, nextResume) in self.frontier[-REACTOR_LIMITS['listing']:]:
+                    nextURL = URL(nextURL)
+                    if not nextResume and not nextURL.isVideo and not nextURL.isAccount: # Pages expandURL() would fetch
+                        self.listing.prefetch(str(nextURL))
+            (url, folder, resume) = self.frontier.pop()
+            self.journal.write(expand = url, folder = folder)
+            (folder, items) = self.expandURL(URL(url), folder, resume)
+            self.journal.write(done = True)
+            self.pushItems(items, folder)
+        self.journal.write(complete = True)
+
+    def pushItems(self, items, folder):
+        '''Adds the videos to the crawl graph and the other items to the frontier, for them to be expanded in order.'''
+        for item in items:
+            if isinstance(item, (int, long)):
+                self.graph.addVideo(item, folder)
+        self.frontier.extend((item, folder, None) for item in reversed(items) if not isinstance(item, (int, long)))
+
+    def expandURL(self, url, folder, resume):
+        '''Reads the page(s) at the URL, returns the number of the folder the items found belong to, and the items as vIDs and URLs.'''
+        if self.api:
+            return self.expandAPIURL(url, folder, resume)
+        if resume: # Continue reading the pages of a folder from where the crawl was interrupted
+            (items, nextLink) = resume
+            self.logger.info("Resuming %s...", url.url)
+            self.journal.write(page = items, next = nextLink)
+            page = self.fetchListing(nextLink)
+            if not page:
+                self.goTo(nextLink)
+            return (folder, [journalItem(item) for item in self.getItemsFromFolder(page, url if url.isVideos or url.isFolder else None, items)])
+        items = None # Read and journaled page by page
         if url.isVideo: # Video
-            if url.vID not in self.vIDs:
-                self.vIDs.append(url.vID)
-            if target is not None:
-                target.add(url.vID)
+            items = (url,)
         elif url.isAccount: # Account main page
             self.logger.info("Processing account %s...", url.account)
-            items = tuple(url.url + suffix for suffix in ('/videos', '/channels', '/albums'))
+            items = tuple(URL(url.url + suffix) for suffix in ('/videos', '/channels', '/albums'))
         elif url.isVideos: # Videos
-            self.goTo(url)
+            page = self.fetchListing(url)
+            if not page:
+                self.goTo(url)
             self.logger.info("Processing videos...")
-            items = self.getItemsFromFolder()
+            folderItems = self.getItemsFromFolder(page, url)
         elif url.isCategory: # Category
-            self.goTo(url)
+            page = self.fetchListing(url)
+            if not page:
+                self.goTo(url)
             self.logger.info("Processing %s...", url.category)
-            items = self.getItemsFromFolder()
+            folderItems = self.getItemsFromFolder(page)
         elif url.isFolder: # Folder
             title = None
-            self.goTo(url)
-            try:
-                title = self.getElement('#page_header h1 a').text # https://vimeo.com/channels/*/videos
-            except NoSuchElementException:
+            page = self.fetchListing(url)
+            if page and page.title:
+                title = page.title
+            else:
+                page = None
+                self.goTo(url)
                 try:
-                    title = self.getElement('#page_header h1').text # https://vimeo.com/album/*
+                    title = self.getElement('#page_header h1 a').text # https://vimeo.com/channels/*/videos
                 except NoSuchElementException:
                     try:
-                        title = self.getElement('#group_header h1 a').get_attribute('title') # https://vimeo.com/groups/*/videos
+                        title = self.getElement('#page_header h1').text # https://vimeo.com/album/*
                     except NoSuchElementException:
                         try:
-                            title = self.getElement('#group_header h1 a').text # backup
-                        except NoSuchElementException, e:
-                            self.error(e.msg)
-                            self.dumpPage()
+                            title = self.getElement('#group_header h1 a').get_attribute('title') # https://vimeo.com/groups/*/videos
+                        except NoSuchElementException:
+                            try:
+                                title = self.getElement('#group_header h1 a').text # backup
+                            except NoSuchElementException, e:
+                                self.error(e.msg)
+                                self.dumpPage()
+            folderItems = ()
             if title:
-                self.logger.info("Processing folder %s", encodeForConsole(title))
-                self.setOperation(encodeForConsole(title))
-                if self.foldersSubdirectory:
-                    dirName = self.createDir(cleanupFileName(title.strip().rstrip('.'))) # unicode
-                    url.createFile(dirName)
-                    if symlink:
-                        target = set()
-                        self.folders.append((dirName, target))
-                items = self.getItemsFromFolder()
+                folder = self.openFolder(url, title, folder)
+                folderItems = self.getItemsFromFolder(page, url)
         else: # Some other page
-            self.goTo(url)
+            page = self.fetchListing(url)
+            if not page:
+                self.goTo(url)
             self.logger.info("Processing page %s...", url.url)
-            items = self.getItemsFromPage()
-        for item in items:
-            self.getItemsFromURL(item, target)
+            items = self.getItemsFromPage(page)
+        if items is not None:
+            self.journal.write(page = [journalItem(item) for item in items], next = None)
+        return (folder, [journalItem(item) for item in (folderItems if items is None else items)])
+
+    def openFolder(self, url, title, folder):
+        '''Creates the subfolder for the links to the videos in the folder, if enabled, returns the folder number the videos belong to.'''
+        self.logger.info("Processing folder %s", encodeForConsole(title))
+        self.setOperation(encodeForConsole(title))
+        if self.foldersSubdirectory:
+            dirName = self.createDir(cleanupFileName(title.strip().rstrip('.'))) # unicode
+            url.createFile(dirName)
+            if symlink:
+                folder = self.graph.addFolder(dirName)
+                self.journal.write(dir = dirName)
+        return folder
+
+    def expandAPIURL(self, url, folder, resume):
+        '''Reads the API resources for the URL, as expandURL() reads the pages, the next page links are API paths.'''
+        if resume:
+            (items, nextPath) = resume
+            self.logger.info("Resuming %s...", url.url)
+            self.journal.write(page = items, next = nextPath)
+            return (folder, [journalItem(item) for item in self.getItemsFromAPI(nextPath, url if url.isVideos or url.isFolder else None, items)])
+        items = None
+        if url.isVideo: # Video
+            items = (url,)
+        elif url.isAccount: # Account main page
+            self.logger.info("Processing account %s...", url.account)
+            items = tuple(URL(url.url + suffix) for suffix in ('/videos', '/channels', '/albums'))
+        elif url.isVideos: # Videos
+            self.logger.info("Processing videos...")
+            folderItems = self.getItemsFromAPI('/users/%s/videos' % url.account, url)
+        elif url.isCategory: # Category
+            self.logger.info("Processing %s...", url.category)
+            folderItems = self.getItemsFromAPI('/users/%s/%s' % (url.account, url.category))
+        elif url.isFolder: # Folder
+            resource = self.apiFolders.pop(str(url), None)
+            if not resource: # Not found in a listing, e.g. the start URL
+                with self.metrics.timer('apiFetch'):
+                    resource = self.api.get(FOLDER_API_PATHS[url.folder] % url.name, fields = VimeoAPI.FOLDER_FIELDS)
+            (title, videosPath) = (resource.get('name'), VimeoAPI.getVideosPath(resource))
+            folderItems = ()
+            if not title:
+                self.error("Failed to get folder name: %s", url.url)
+            elif not videosPath:
+                self.error("Failed to get folder videos: %s", url.url)
+            else:
+                folder = self.openFolder(url, title, folder)
+                folderItems = self.getItemsFromAPI(videosPath, url)
+        else: # Some other page
+            self.error("Can't process %s with the API", url.url)
+            items = ()
+        if items is not None:
+            self.journal.write(page = [journalItem(item) for item in items], next = None)
+        return (folder, [journalItem(item) for item in (folderItems if items is None else items)])
+
+    def getItemsFromAPI(self, path, url = None, items = ()):
+        '''Reads the pages of the API collection, as getItemsFromFolder() reads the listing pages, the video resources are kept for processAPIVideo().'''
+        items = [URL(item) for item in items] # Items of the pages read before the crawl was resumed
+        numPages = 0
+        folderKey = str(url) if url else None
+        knownVIDs = self.stateDatabase.getFolderVIDs(folderKey) if folderKey else set()
+        stoppedEarly = False
+        for _ in xrange(self.maxItems) if self.maxItems is not None else count():
+            self.logger.debug("Fetching %s", path)
+            self.setOperation(path)
+            self.metrics.count('pages')
+            with self.metrics.timer('apiFetch'):
+                (resources, path) = self.api.getPage(path)
+            numPages += 1
+            pageItems = []
+            for resource in resources[:self.maxItems]:
+                vID = VimeoAPI.getVID(resource)
+                if vID:
+                    self.apiVideos[vID] = resource
+                    pageItems.append(URL(vID))
+                elif resource.get('link') and VIMEO in resource['link']:
+                    item = URL(resource['link'])
+                    if item.isFolder:
+                        self.apiFolders[str(item)] = resource
+                    pageItems.append(item)
+            self.logger.debug("Got %d items", len(pageItems))
+            if self.updateOnly and self.isKnownPage(pageItems, knownVIDs):
+                self.logger.debug("Page contains only known videos, skipping the rest of the folder")
+                foundVIDs = set(item.vID for item in items + pageItems if item.isVideo)
+                pageItems.extend(URL(vID) for vID in sorted(knownVIDs - foundVIDs, reverse = True))
+                stoppedEarly = True
+                path = None
+            items.extend(pageItems)
+            self.journal.write(page = [journalItem(item) for item in pageItems], next = path)
+            if not path:
+                break
+        items = tuple(items)
+        if numPages > 1:
+            self.logger.debug("Got total of %d items", len(items))
+        if folderKey:
+            self.stateDatabase.setFolderVIDs(folderKey, tuple(item.vID for item in items if item.isVideo), not stoppedEarly)
+        return items
+
+    def resumeFrontier(self):
+        '''Restores the crawl graph and the frontier by replaying the journal, returns True if the crawl was complete.'''
+        records = self.journal.load()
+        current = None # [url, folder number, items, next page link, is folder created] of the URL being expanded
+        self.frontier = []
+        def suspend(current):
+            (url, folder, items, nextLink, hasDir) = current
+            if items and not nextLink: # All the pages were read
+                self.pushItems(items, folder)
+            elif items or hasDir:
+                self.frontier.append((url, folder, (items, nextLink or url)))
+            else:
+                self.frontier.append((url, folder, None))
+        for record in records:
+            if 'start' in record: # The crawl was started over
+                current = None
+                self.graph = CrawlGraph()
+                self.frontier = [(record['start'], None, None)]
+                if not self.startURL or self.startURL.url != record['start']:
+                    self.startURL = URL(record['start'])
+            elif 'expand' in record:
+                if current:
+                    suspend(current)
+                (url, folder, resume) = self.frontier.pop()
+                if url != record['expand'] or folder != record['folder']:
+                    raise ValueError("Crawl journal is inconsistent at %s" % record['expand'])
+                current = [url, folder, [], None, bool(resume)]
+            elif 'dir' in record:
+                current[1] = self.graph.addFolder(record['dir'])
+                current[4] = True
+            elif 'page' in record:
+                current[2].extend(record['page'])
+                current[3] = record['next']
+            elif 'done' in record:
+                self.pushItems(current[2], current[1])
+                current = None
+            elif 'complete' in record:
+                return True
+        if current:
+            suspend(current)
+        return False
 
     def verifyVideoFile(self, fileName):
-        self.logger.debug("Verifying...")
-        subprocess = Popen('ffmpeg -v error -i "%s" -f null -' % fileName, shell = True, stdout = PIPE, stderr = STDOUT)
-        output = subprocess.communicate()[0]
+        self.logger.debug("Verifying %s...", basename(fileName))
+        self.metrics.count('verifications')
+        with self.metrics.timer('verify'):
+            subprocess = Popen('ffmpeg -v error -i "%s" -f null -' % fileName, shell = True, stdout = PIPE, stderr = STDOUT)
+            output = subprocess.communicate()[0]
         if subprocess.returncode:
             self.error("Verification failed, code %d", subprocess.returncode)
             return False
@@ -625,19 +2890,259 @@ class VimeoCrawler(object):
             return False
         return True
 
-    def createLink(self, dirName, fileName):
+    def verifyLater(self, vID, videoFileName, targetVideoFileName, operation):
+        '''Queues the file for verification, unless it was verified OK before and hasn't changed since.'''
+        if SegmentedDownload.isPending(targetVideoFileName):
+            self.logger.debug("Segmented download incomplete, not verified")
+            return
+        state = self.stateDatabase.get(vID)
+        job = VerifyJob(vID, targetVideoFileName, videoFileName, operation)
+        if state and state['verified'] and state['fileName'] == videoFileName and not self.reverify:
+            (localSize, localMTime) = self.inventory.get(videoFileName)
+            if (state['localSize'], state['localMTime']) == (localSize, localMTime):
+                self.logger.debug("Verified before")
+                return
+            if state['localSize'] == localSize: # Only the modification time has changed, checking the content hash is enough
+                (job.sha256, job.sample) = (state['sha256'], state['sample'])
+        self.verifyPool.submit(job)
+
+    def verifyVideoSafely(self, job):
+        self.setOperation(job.operation)
+        try:
+            if job.sha256:
+                with self.metrics.timer('hash'):
+                    digest = ContentHash.hashFile(job.fileName)
+                if digest == job.sha256:
+                    self.logger.debug("%s content unchanged, verified before", basename(job.fileName))
+                    self.saveState(job.vID, job.videoFileName, job.fileName, True, sha256 = job.sha256, sample = job.sample)
+                    return
+            verified = self.verifyVideoFile(job.fileName)
+            if verified:
+                self.logger.debug("%s verified OK", basename(job.fileName))
+            if job.vID is not None:
+                (localSize, localMTime) = self.inventory.get(job.videoFileName)
+                state = self.stateDatabase.get(job.vID)
+                content = {}
+                if verified and localSize and not (state and state['sha256'] and (state['localSize'], state['localMTime']) == (localSize, localMTime)):
+                    # Recorded, so that the file doesn't have to be decoded again if only its modification time changes
+                    with self.metrics.timer('hash'):
+                        content = {'sha256': ContentHash.hashFile(job.fileName), 'sample': ContentHash.fileSample(job.fileName, localSize)}
+                self.saveState(job.vID, job.videoFileName, job.fileName, verified, **content)
+        except Exception, e:
+            self.error(format_exc() if self.verbose else e)
+
+    def verifyArchive(self):
+        '''Verifies all the video files in the target directory, without crawling.'''
+        self.logger.info("Verifying existing files...")
+        numFiles = 0
+        for fileName in sorted(self.inventory.files): # unicode
+            vID = getVIDFromFileName(fileName)
+            if vID is None or fileName.rpartition('.')[2].lower() in ('jpg', 'html'): # Not a file named by processVideo(), or a thumbnail or details of a video
+                continue
+            targetFileName = encodeForFileSystem(join(self.targetDirectory, fileName))
+            self.verifyLater(vID, fileName, targetFileName, encodeForConsole(fileName))
+            numFiles += 1
+        self.logger.info("Got %d files", numFiles)
+
+    def readLinks(self, dirName):
+        '''Returns the links to the video files in the folder, as file name => symbolic link target, or (device, inode) of a hard link.'''
+        links = {}
+        for fileName in listdir(unicode(dirName)):
+            if getVIDFromFileName(fileName) is None:
+                continue # Not a video file, e.g. source.url
+            linkFileName = join(dirName, fileName) # unicode
+            try:
+                info = lstat(linkFileName)
+                if S_ISLNK(info.st_mode):
+                    links[fileName] = readlink(linkFileName) if readlink else None
+                elif S_ISREG(info.st_mode):
+                    links[fileName] = (info.st_dev, info.st_ino)
+            except OSError, e:
+                self.logger.warning("Can't read link at %s: %s", encodeForConsole(linkFileName), e)
+        return links
+
+    def linkTarget(self, dirName, fileName):
+        '''Returns the symbolic link target, or (device, inode) to hard link to, for the link to the file in the folder, or None if the file is missing.'''
+        if self.useHardLinks:
+            info = self.inventory.stat(fileName)
+            return (info.st_dev, info.st_ino) if info else None
+        return relpath(join(self.targetDirectory, fileName), dirName) if fileName in self.inventory.files else None
+
+    def reconcileLinks(self):
+        '''Brings the links in the folders in line with the videos found in them, reading every folder once and changing only the links that differ.
+
+        Links to the videos no longer in a folder are reported, and removed if all the folders were read completely.
+        '''
+        removeStale = self.graphComplete and self.maxItems is None
+        folderFiles = dict((dirName, set()) for dirName in self.graph.folders) # dirName => unicode file names to link to
+        for vID in self.graph.vIDs:
+            dirNames = self.graph.getFolders(vID)
+            if dirNames:
+                fileNames = self.getLinkedFiles(vID)
+                for dirName in dirNames:
+                    folderFiles[dirName].update(fileNames)
+        counts = dict.fromkeys(('created', 'retargeted', 'removed'), 0)
+        with self.metrics.timer('links'):
+            for (dirName, fileNames) in sorted(folderFiles.iteritems()):
+                try:
+                    links = self.readLinks(dirName)
+                except OSError, e:
+                    self.error("Can't read folder %s: %s", encodeForConsole(dirName), e)
+                    continue
+                for fileName in sorted(fileNames):
+                    target = self.linkTarget(dirName, fileName)
+                    if target is None:
+                        continue # Not downloaded
+                    existing = links.get(fileName, False)
+                    if existing is False:
+                        self.createLink(dirName, fileName, False)
+                        counts['created'] += 1
+                    elif existing != target and (existing is not None or self.useHardLinks):
+                        self.createLink(dirName, fileName, True)
+                        counts['retargeted'] += 1
+                for fileName in sorted(set(links) - fileNames):
+                    linkFileName = join(dirName, fileName) # unicode
+                    self.logger.warning("Stale link, the video is no longer in the folder: %s", encodeForConsole(linkFileName))
+                    if removeStale:
+                        try:
+                            remove(linkFileName)
+                            counts['removed'] += 1
+                        except OSError, e:
+                            self.error("Can't remove link at %s: %s", encodeForConsole(linkFileName), e)
+        if any(counts.itervalues()):
+            self.logger.info("Links: %d created, %d retargeted, %d stale removed", counts['created'], counts['retargeted'], counts['removed'])
+
+    def getLinkedFiles(self, vID):
+        '''Returns the unicode names of the current files of the video to be linked in its folders, not any other files with its vID.'''
+        fileNames = self.videoFiles.get(vID)
+        if not fileNames: # Skipped as unchanged, or failed to process during this run
+            state = self.stateDatabase.get(vID)
+            if not state or not state['fileName']:
+                return ()
+            fileNameBase = state['fileName'][:state['fileName'].rfind('.')]
+            fileNames = (state['fileName'],) + tuple('%s.%s' % (fileNameBase, ext) for ext in ('jpg', 'html'))
+        (videoFileName, thumbnailFileName, detailsFileName) = fileNames
+        if SegmentedDownload.isPending(encodeForFileSystem(join(self.targetDirectory, videoFileName))):
+            videoFileName = None
+        return tuple(fileName for (needed, fileName) in ((True, videoFileName), (self.saveThumbnails, thumbnailFileName), (self.saveDetails, detailsFileName)) if needed and fileName)
+
+    def createLink(self, dirName, fileName, replace):
         linkFileName = join(dirName, fileName) # unicode
         try:
-            if lexists(linkFileName):
+            if replace:
                 remove(linkFileName)
-        except:
-            pass
-        try:
-            (hardlink if self.useHardLinks else symlink)(join('..', fileName), linkFileName)
+            if self.useHardLinks:
+                hardlink(join(self.targetDirectory, fileName), linkFileName)
+            else:
+                symlink(relpath(join(self.targetDirectory, fileName), dirName), linkFileName)
         except Exception, e:
             self.error("Can't create link at %s: %s", encodeForConsole(linkFileName), e)
 
+    def saveState(self, vID, videoFileName, targetVideoFileName, verified = None, **remoteState):
+        (localSize, localMTime) = self.inventory.get(videoFileName)
+        state = self.stateDatabase.get(vID)
+        unchanged = state and state['localSize'] == localSize and state['localMTime'] == localMTime
+        if verified is None and unchanged: # Preserve the previous verification result if the file hasn't changed since
+            verified = state['verified']
+        if not unchanged: # The content hash of the previous file doesn't apply
+            remoteState.setdefault('sha256', None)
+            remoteState.setdefault('sample', None)
+        self.stateDatabase.update(vID, fileName = videoFileName, localSize = localSize, localMTime = localMTime, verified = verified, processed = time(), **remoteState)
+
+    def linkDuplicate(self, vID, videoFileName, targetVideoFileName, size, sha256 = None, sample = None):
+        '''Replaces the file with a hard link to an identical unchanged file of another video, returns (vID, sha256) of that video or None.'''
+        for (otherVID, otherFileName, otherMTime, otherSHA256, otherSample) in self.stateDatabase.findContent(size, vID, sha256):
+            if sample and sample != otherSample or not otherFileName or self.inventory.get(otherFileName) != (size, otherMTime):
+                continue # Different content, or the file has changed since it was hashed
+            try:
+                if lexists(targetVideoFileName):
+                    remove(targetVideoFileName)
+                hardlink(encodeForFileSystem(join(self.targetDirectory, otherFileName)), targetVideoFileName)
+            except OSError, e:
+                self.logger.warning("Error linking to the identical file of video %d: %s", otherVID, e)
+                continue
+            self.inventory.refresh(videoFileName)
+            self.metrics.count('deduplicatedBytes', size)
+            return (otherVID, otherSHA256)
+        return None
+
+    def precheckDuplicate(self, video, size, videoFileName, targetVideoFileName):
+        '''Links the file to an identical file of another video instead of downloading it, if the remote file size and samples match, returns True if so.'''
+        if not self.stateDatabase.findContent(size, video.vID):
+            return False
+        try:
+            if not self.sampleSession:
+                self.sampleSession = createSession(1, self.retryCount)
+            samples = []
+            for byteRange in ('0-%d' % (ContentHash.SAMPLE_SIZE - 1), '-%d' % ContentHash.SAMPLE_SIZE): # Head and tail
+                response = self.sampleSession.get(video.link, headers = {'Range': 'bytes=%s' % byteRange, 'User-Agent': video.userAgent}, timeout = self.timeout,
+                                                  cookies = dict((str(cookie['name']), str(cookie['value'])) for cookie in video.cookies), stream = True)
+                try:
+                    response.raise_for_status()
+                    if response.status_code != 206: # The body would be the whole file
+                        raise IOError("Server doesn't support range requests")
+                    samples.append(response.content)
+                finally:
+                    response.close()
+        except Exception, e:
+            self.logger.warning("Error getting remote file samples: %s", e)
+            return False
+        sample = ContentHash.sampleDigest(size, *samples)
+        duplicate = self.linkDuplicate(video.vID, videoFileName, targetVideoFileName, size, sample = sample)
+        if not duplicate:
+            return False
+        self.logger.info("Identical to video %d by size and samples, linked instead of downloading", duplicate[0])
+        self.saveState(video.vID, videoFileName, targetVideoFileName, sha256 = duplicate[1], sample = sample, **video.remoteState)
+        return True
+
+    def unshareFile(self, vID, videoFileName, targetVideoFileName):
+        '''Removes the file about to be downloaded again if it's linked to identical files, so that they are not changed by the download.'''
+        state = self.stateDatabase.get(vID)
+        try:
+            if state and state['sha256'] and stat(targetVideoFileName).st_nlink > 1:
+                self.logger.debug("Unlinking the file shared with identical files")
+                remove(targetVideoFileName)
+                self.inventory.refresh(videoFileName)
+        except OSError:
+            pass
+
+    def processUnchangedVideo(self, vID, number):
+        '''Skips the video page if the state database shows the video as completely downloaded and the local file unchanged since.'''
+        if self.revisit or self.setLanguage or self.setPreset:
+            return False
+        state = self.stateDatabase.get(vID)
+        if not state or not state['fileName'] or not state['remoteSize'] or state['localSize'] != state['remoteSize']:
+            return False
+        if self.verifyExisting and not state['verified']:
+            return False
+        videoFileName = state['fileName'] # unicode
+        fileNameBase = videoFileName[:videoFileName.rfind('.')]
+        (thumbnailFileName, detailsFileName) = ('%s.%s' % (fileNameBase, ext) for ext in ('jpg', 'html')) # unicode
+        if self.inventory.get(videoFileName) != (state['localSize'], state['localMTime']):
+            return False
+        for (needed, fileName) in ((self.saveThumbnails, thumbnailFileName), (self.saveDetails, detailsFileName)):
+            if needed and fileName not in self.inventory.files:
+                return False
+        operation = '%d %s (%s, %s, unchanged) %d/%d %d%%' % (vID, encodeForConsole(fileNameBase), encodeForConsole(state['quality'] or ''), readableSize(state['remoteSize']), number, len(self.vIDs), int(number * 100.0 / len(self.vIDs)))
+        self.logger.info(operation)
+        self.setOperation(operation)
+        self.stateDatabase.update(vID, processed = time())
+        if self.reverify:
+            self.verifyLater(vID, videoFileName, encodeForFileSystem(join(self.targetDirectory, videoFileName)), operation)
+        return True
+
     def processVideo(self, vID, number):
+        '''Collects the video information in the browser, the rest is done by completeVideo().'''
+        video = PendingVideo(vID, number)
+        if self.processUnchangedVideo(vID, number):
+            return video
+        if self.api:
+            return self.processAPIVideo(video)
+        cacheEntry = None
+        if self.pageCache and not self.setLanguage and not self.setPreset: # Settings can only be changed on the page
+            cacheEntry = self.pageCache.get(VIMEO_URL % vID)
+            if cacheEntry and cacheEntry['fresh'] and self.isCachedVideoComplete(cacheEntry['data']):
+                return self.processCachedVideo(video, cacheEntry['data'])
         title = ''
         download = None
         isPrivate = None
@@ -685,6 +3190,7 @@ class VimeoCrawler(object):
                     except NoSuchElementException:
                         self.error("Failed to get video thumbnail image URL")
                         self.dumpPage()
+            downloadPanelStarted = time()
             try:
                 if legacyStyle:
                     downloadButton = self.getElement('.iconify_down_b')
@@ -695,12 +3201,13 @@ class VimeoCrawler(object):
                 download = self.getElement('#download' if legacyStyle else "#download_panel")
             except NoSuchElementException, e:
                 pass
+            self.metrics.observe('downloadPanel', time() - downloadPanelStarted)
         except NoSuchElementException, e:
             self.error(e.msg)
             self.dumpPage()
-            return
+            return video
         # Parse download links
-        link = linkTitle = linkSize = localSize = downloadOK = downloadSkip = None
+        link = linkTitle = None
         if download:
             xpath = './/a[%s]' if legacyStyle else './/td[%s]'
             for preference in FILE_PREFERENCES:
@@ -714,30 +3221,18 @@ class VimeoCrawler(object):
                 if linkTitle:
                     link = linkTitle if legacyStyle else linkTitle.find_element_by_xpath('./following-sibling::td/a[.="Download"]')
                     break
-        userAgent = str(self.driver.execute_script('return window.navigator.userAgent'))
-        cookies = self.driver.get_cookies()
+            if not link:
+                self.error("Failed to obtain download link")
+                self.dumpPage()
+        (video.userAgent, video.cookies) = self.getBrowserState()
         if link: # Parse chosen download link
             extension = link.get_attribute('download').split('.')[-1] # unicode
-            description = encodeForConsole('%s/%s' % (linkTitle.text, extension.upper()))
-            link = str(link.get_attribute('href'))
-            if self.getFileSizes:
-                try:
-                    request = requests.get(link, stream = True, headers = {'user-agent': userAgent}, cookies = dict((str(cookie['name']), str(cookie['value'])) for cookie in cookies))
-                    request.close()
-                    linkSize = int(request.headers['content-length'])
-                    self.totalFileSize += linkSize
-                    description += ', %s' % readableSize(linkSize)
-                except Exception, e:
-                    self.error("Error getting remote file size: %s", e)
+            video.description = encodeForConsole('%s/%s' % (linkTitle.text, extension.upper()))
+            video.remoteState['quality'] = linkTitle.text
+            video.link = str(link.get_attribute('href'))
+            self.probeLater(video)
         else:
-            description = extension = 'NONE'
-        # Prepare file information
-        operation = '%d %s%s (%s) %d/%d %d%%%s' % (vID, title, ' [P]' if isPrivate else (' [%s]' % author) if author else '', description, number, len(self.vIDs), int(number * 100.0 / len(self.vIDs)), (' %s' % readableSize(self.totalFileSize)) if self.totalFileSize else '')
-        self.logger.info(operation)
-        self.setOperation(operation)
-        fileNameBase = cleanupFileName(' '.join(((title.decode(CONSOLE_ENCODING),) if title else ()) + (str(vID),))) # unicode
-        (videoFileName, thumbnailFileName, detailsFileName) = ('%s.%s' % (fileNameBase, ext) for ext in (extension.lower(), 'jpg', 'html')) # unicode
-        (targetVideoFileName, targetThumbnailFileName, targetDetailsFileName) = (encodeForFileSystem(join(self.targetDirectory, fileName)) for fileName in (videoFileName, thumbnailFileName, detailsFileName))
+            extension = 'NONE'
         if not legacyStyle and download:
             download.send_keys(Keys.ESCAPE)
         if self.setLanguage or self.setPreset:
@@ -760,7 +3255,7 @@ class VimeoCrawler(object):
                                 if len(ls) != 1:
                                     ls = [l for l in languages if l.get_attribute('value').capitalize().startswith(self.setLanguage)]
                                 if len(ls) == 1:
-                                    self.updateCompleted = False
+                                    video.updateCompleted = False
                                     self.logger.debug("Language not set, setting to %s", ls[0].text)
                                     ls[0].click()
                                     submitButton = self.getElement('#settings_form input[type=submit]')
@@ -787,7 +3282,7 @@ class VimeoCrawler(object):
                                     else:
                                         presets = [p for p in presets if p.text.capitalize() == self.setPreset]
                                         if presets:
-                                            self.updateCompleted = False
+                                            video.updateCompleted = False
                                             self.logger.debug("Preset %s, setting to %s", ('is set to %s' % currentPreset.text.capitalize()) if currentPreset else 'is not set', self.setPreset)
                                             presets[0].click()
                                             saveEmbedSettingsButton = self.getElement('#settings_form input[name=save_embed_settings]')
@@ -805,205 +3300,662 @@ class VimeoCrawler(object):
                 except NoSuchElementException:
                     self.error("Failed to access settings")
                     self.dumpPage()
+        # Prepare file information
+        video.title = title
+        video.label = ' [P]' if isPrivate else (' [%s]' % author) if author else ''
+        video.hasDownload = download is not None
+        video.detailsText = detailsText
+        video.videoThumbnailLink = videoThumbnailLink
+        fileNameBase = cleanupFileName(' '.join(((title.decode(CONSOLE_ENCODING),) if title else ()) + (str(vID),))) # unicode
+        video.fileNames = tuple('%s.%s' % (fileNameBase, ext) for ext in (extension.lower(), 'jpg', 'html')) # unicode
+        video.isPending = True
+        if self.pageCache and video.link: # Only complete results are cached, the page may be broken temporarily
+            self.pageCache.put(VIMEO_URL % vID, {'title': video.title.decode(CONSOLE_ENCODING), 'label': video.label.decode(CONSOLE_ENCODING),
+                                                 'description': video.description.decode(CONSOLE_ENCODING), 'quality': video.remoteState.get('quality'),
+                                                 'link': video.link, 'detailsText': detailsText, 'videoThumbnailLink': videoThumbnailLink, 'fileNames': video.fileNames,
+                                                 'details': self.saveDetails, 'thumbnails': self.saveThumbnails},
+                               expired = cacheEntry is not None)
+        return video
+
+    def isCachedVideoComplete(self, data):
+        '''Returns True if the page was read with all the information the current options ask for, e.g. it has the details if --details is on.'''
+        return all(data.get(field) or not needed for (field, needed) in (('details', self.saveDetails), ('thumbnails', self.saveThumbnails)))
+
+    def processCachedVideo(self, video, data):
+        '''Fills in the video information saved in the page cache, instead of collecting it in the browser.'''
+        self.logger.debug("Using the cached video page")
+        (video.title, video.label, video.description) = (encodeForConsole(data[field]) for field in ('title', 'label', 'description'))
+        if data['quality']:
+            video.remoteState['quality'] = data['quality']
+        video.hasDownload = True
+        video.link = str(data['link'])
+        video.detailsText = data['detailsText']
+        video.videoThumbnailLink = data['videoThumbnailLink']
+        video.fileNames = tuple(data['fileNames'])
+        (video.userAgent, video.cookies) = self.getBrowserState()
+        self.probeLater(video)
+        video.isPending = True
+        return video
+
+    def processAPIVideo(self, video):
+        '''Fills in the video information from the API resource, read with the listing, or read again if the download links expire soon.'''
+        vID = video.vID
+        resource = self.apiVideos.pop(vID, None)
+        if not resource or VimeoAPI.isExpired(resource):
+            try:
+                with self.metrics.timer('apiFetch'):
+                    resource = self.api.get('/videos/%d' % vID, fields = VimeoAPI.FIELDS)
+            except Exception, e:
+                self.error("Failed to get video %d: %s", vID, e)
+                return video
+        title = encodeForConsole((resource.get('name') or '').strip().rstrip('.'))
+        author = (resource.get('user') or {}).get('name')
+        author = None if not author or author == self.userName else encodeForConsole(author)
+        isPrivate = (resource.get('privacy') or {}).get('view') == 'password'
+        (label, download) = VimeoAPI.chooseDownload(resource.get('download') or ())
+        video.userAgent = VimeoAPI.USER_AGENT
+        video.cookies = () # Download links are signed
+        if download:
+            extension = urlparse(download['link']).path.rpartition('/')[2].rpartition('.')[2] or 'mp4'
+            if not extension.isalnum():
+                extension = 'mp4'
+            video.description = encodeForConsole('%s/%s' % (label, extension.upper()))
+            video.remoteState['quality'] = label
+            video.link = str(download['link'])
+            if download.get('size') and self.getFileSizes: # The size is known, no need to probe
+                video.probe = SizeProbe(video.link)
+                (video.probe.size, video.probe.seconds) = (int(download['size']), 0)
+                video.probe.event.set()
+            else:
+                self.probeLater(video)
+        else:
+            self.error("Failed to obtain download link")
+            extension = 'NONE'
+        sizes = (resource.get('pictures') or {}).get('sizes') or ()
+        video.title = title
+        video.label = ' [P]' if isPrivate else (' [%s]' % author) if author else ''
+        video.hasDownload = download is not None
+        video.detailsText = escape(resource.get('description') or '').replace('\n', '<br>\n')
+        video.videoThumbnailLink = sizes[-1].get('link') if sizes else None # Sizes are listed smallest first
+        fileNameBase = cleanupFileName(' '.join(((title.decode(CONSOLE_ENCODING),) if title else ()) + (str(vID),))) # unicode
+        video.fileNames = tuple('%s.%s' % (fileNameBase, ext) for ext in (extension.lower(), 'jpg', 'html')) # unicode
+        video.isPending = True
+        return video
+
+    def probeLater(self, video):
+        '''Starts probing the remote file size, it runs while the browser continues working.'''
+        if self.getFileSizes:
+            video.probe = self.sizeProber.submit(video.link, video.userAgent, video.cookies)
+
+    def completeVideo(self, video):
+        '''Downloads the files of the video processed by processVideo(), returns True if the video was already completely processed before.'''
+        if video.fileNames:
+            self.videoFiles[video.vID] = video.fileNames
+        if not video.isPending:
+            return video.updateCompleted
+        vID = video.vID
+        linkSize = localSize = downloadOK = downloadSkip = None
+        if video.probe:
+            try:
+                with self.metrics.timer('sizeProbeWait'):
+                    video.probe.wait()
+                self.metrics.observe('sizeProbe', video.probe.seconds)
+                linkSize = video.probe.size
+                video.remoteState.update(remoteSize = linkSize, etag = video.probe.etag, lastModified = video.probe.lastModified)
+                with self.errorsLock:
+                    self.totalFileSize += linkSize
+                video.description += ', %s' % readableSize(linkSize)
+            except Exception, e:
+                self.setOperation(VIMEO_URL % vID)
+                self.error("Error getting remote file size: %s", e)
+        operation = '%d %s%s (%s) %d/%d %d%%%s' % (vID, video.title, video.label, video.description, video.number, len(self.vIDs), int(video.number * 100.0 / len(self.vIDs)), (' %s' % readableSize(self.totalFileSize)) if self.totalFileSize else '')
+        self.logger.info(operation)
+        self.setOperation(operation)
+        self.metrics.count('videos')
+        (videoFileName, thumbnailFileName, detailsFileName) = video.fileNames # unicode
+        (targetVideoFileName, targetThumbnailFileName, targetDetailsFileName) = (encodeForFileSystem(join(self.targetDirectory, fileName)) for fileName in video.fileNames)
         # Saving video details
         if self.saveDetails:
             self.logger.debug("Saving video details")
             try:
                 with codecsOpen(targetDetailsFileName, 'w', 'UTF-8') as f:
-                    f.write(detailsText)
+                    f.write(video.detailsText)
+                self.inventory.refresh(detailsFileName)
             except IOError, e:
                 self.logger.warning("Error saving details text: %s", e)
         # Saving video thumbnail image
-        if self.saveThumbnails and videoThumbnailLink:
-            self.logger.debug("Getting video thumbnail image...")
-            try:
-                grabber = URLGrabber(reget = 'simple', timeout = self.timeout, user_agent = userAgent,
-                                     http_headers = tuple((str(cookie['name']), str(cookie['value'])) for cookie in cookies))
-                grabber.urlgrab(videoThumbnailLink, filename = targetThumbnailFileName)
-                try:
-                    if imageOpen and imageOpen(targetThumbnailFileName).format != 'JPEG':
-                        self.error("Video thumbnail image is not JPEG")
-                        self.dumpPage()
-                    else:
-                        self.logger.debug("OK")
-                except IOError, e:
-                    self.logger.warning("Video thumbnail image verification failed: %s", e)
-            except URLGrabError, e:
-                if e.errno == 14 and e.code == 22:
-                    httpError = HTTP_ERROR_PATTERN.match(e.strerror).group(1)
-                    if not self.getFileSizes and ' 416 ' in httpError:
-                        pass # ok
-                    else:
-                        self.logger.warning("Video thumbnail image download failed: %s", httpError)
-                else:
-                    self.logger.warning("Video thumbnail image download failed: %s", e.strerror if e.errno == 14 else e)
-        if not download:
+        if self.saveThumbnails and video.videoThumbnailLink:
+            state = self.stateDatabase.get(vID)
+            job = ThumbnailJob(vID, video.videoThumbnailLink, video.userAgent, video.cookies, thumbnailFileName, targetThumbnailFileName,
+                               state['thumbnailETag'] if state and thumbnailFileName in self.inventory.files else None, operation)
+            if self.reactor:
+                self.reactor.spawn(self.thumbnailTask(job))
+            elif self.thumbnailPool:
+                self.thumbnailPool.submit(job)
+            else:
+                self.logger.debug("Getting video thumbnail image...")
+                self.getThumbnailSafely(job)
+        if not video.hasDownload:
             self.logger.warning("Download function not available")
-        elif not link:
-            self.error("Failed to obtain download link")
-            self.dumpPage()
-        else: # Downloading file
-            localSize = getFileSize(targetVideoFileName)
-            if localSize and linkSize:
+        elif video.link: # Downloading file
+            localSize = self.inventory.getSize(videoFileName)
+            incomplete = SegmentedDownload.isPending(targetVideoFileName) # Preallocated to the full size, but not downloaded yet
+            if localSize and linkSize and not incomplete:
                 if localSize == linkSize:
                     downloadOK = True
                 elif localSize > linkSize:
-                    self.updateCompleted = False
+                    video.updateCompleted = False
                     self.error("Local file is larger (%d) than remote file (%d)", localSize, linkSize)
                     downloadSkip = True
-            if downloadOK or downloadSkip or localSize and not linkSize:
-                if self.verifyExisting and not self.verifyVideoFile(targetVideoFileName):
-                    downloadOK = False
+            if not incomplete and (downloadOK or downloadSkip or localSize and not linkSize):
+                if self.verifyExisting: # Before the state is saved, as it may show the file was verified before
+                    self.verifyLater(vID, videoFileName, targetVideoFileName, operation)
+                self.saveState(vID, videoFileName, targetVideoFileName, **video.remoteState)
+            elif self.doDownload and self.precheckDuplicates and linkSize and not localSize and self.precheckDuplicate(video, linkSize, videoFileName, targetVideoFileName):
+                downloadOK = True
             elif self.doDownload:
-                timeout = self.timeout
-                class ProgressIndicator(object):
-                    QUANTUM = 10 * 1024 * 1024 # 10 megabytes
-                    ACTION = r'--\\||//' # update() often gets called in pairs, this smoothes things up
-                    action = len(ACTION) - 1
-
-                    def progress(self, s, suffix = ''):
-                        self.action = (self.action + 1) % len(self.ACTION)
-                        stdout.write('\b%s%s' % (s, suffix + '\n' if suffix else self.ACTION[self.action]))
-
-                    def start(self, *_args, **kwargs):
-                        self.length = kwargs.get('length') or kwargs.get('size')
-                        self.started = False
-                        self.totalRead = 0
-                        self.lastData = time()
-                        self.count = 0
-                        self.action = len(self.ACTION) - 1
-                        self.progress("Downloading: ")
-
-                    def update(self, totalRead, suffix = ''):
-                        if totalRead == 0:
-                            self.started = True
-                        elif totalRead <= self.totalRead:
-                            if time() > self.lastData + timeout:
-                                raise URLGrabError("Download seems stalled")
-                        else:
-                            self.totalRead = totalRead
-                            self.lastData = time()
-                        oldCount = self.count
-                        self.count = int(totalRead // self.QUANTUM) + 1
-                        self.progress(('=' if self.started else '+') * max(0, self.count - oldCount), suffix)
-                        self.started = True
-
-                    def end(self, totalRead):
-                        self.update(totalRead, 'OK')
-
-                progressIndicator = ProgressIndicator()
-                grabber = URLGrabber(reget = 'simple', timeout = self.timeout, progress_obj = progressIndicator, user_agent = userAgent,
-                                     http_headers = tuple((str(cookie['name']), str(cookie['value'])) for cookie in cookies))
-                for _ in xrange(self.retryCount):
-                    try:
-                        grabber.urlgrab(link, filename = targetVideoFileName)
-                        self.updateCompleted = False
-                        downloadOK = True
-                        break
-                    except URLGrabError, e:
-                        if e.errno == 14 and e.code == 22:
-                            httpError = HTTP_ERROR_PATTERN.match(e.strerror).group(1)
-                            if not self.getFileSizes and ' 416 ' in httpError:
-                                downloadOK = True
-                            else:
-                                self.logger.warning("Download failed: %s", httpError)
-                        else:
-                            self.logger.warning("Download failed: %s", e.strerror if e.errno == 14 else e)
-                    except KeyboardInterrupt:
-                        self.logger.warning("Download interrupted")
+                video.updateCompleted = False
+                self.unshareFile(vID, videoFileName, targetVideoFileName)
+                job = DownloadJob(vID, video.link, linkSize, targetVideoFileName, video.userAgent, video.cookies, operation, videoFileName, video.remoteState)
+                if self.reactor:
+                    while not self.downloadSlots.acquire(False): # Doesn't wait forever if the reactor is gone
+                        self.reactor.check()
+                        sleep(0.1)
+                    self.reactor.spawn(self.downloadTask(job))
+                elif self.downloadPool:
+                    self.downloadPool.submit(job)
                 else:
-                    self.updateCompleted = False
-                    self.error("Download ultimately failed after %d retries", self.retryCount)
-                if downloadOK:
-                    localSize = getFileSize(targetVideoFileName)
-                    if not localSize:
-                        self.updateCompleted = False
-                        self.error("Downloaded file seems corrupt")
-                        downloadOK = False
-                    elif linkSize:
-                        if localSize > linkSize:
-                            self.updateCompleted = False
-                            self.error("Downloaded file larger (%d) than remote file (%d)", localSize, linkSize)
-                            downloadOK = False
-                        elif localSize < linkSize:
-                            self.updateCompleted = False
-                            self.error("Downloaded file smaller (%d) than remote file (%d)", localSize, linkSize)
-                            downloadOK = False
-                        elif self.verifyContent and not self.verifyVideoFile(targetVideoFileName):
-                            self.updateCompleted = False
-                            downloadOK = False
+                    self.downloadVideo(job)
             if downloadOK:
                 self.logger.debug("Video OK")
             elif downloadSkip or not self.doDownload:
                 self.logger.debug("Download SKIPPED")
-        # Creating symbolic links, if enabled
-        for dirName in (dirName for (dirName, vIDs) in self.folders if vID in vIDs):
-            self.createLink(dirName, videoFileName) # unicode
-            self.createLink(dirName, thumbnailFileName) # unicode
-            self.createLink(dirName, detailsFileName) # unicode
+        return video.updateCompleted
+
+    def saveThumbnail(self, job, code, data, etag):
+        '''Saves the downloaded thumbnail image if it's JPEG, checking only the magic bytes, 304 means the saved image is still current.'''
+        if code == 304:
+            self.logger.debug("Video thumbnail image not modified")
+            self.metrics.count('thumbnailsNotModified')
+        elif not data.startswith(JPEG_MAGIC):
+            self.error("Video thumbnail image is not JPEG")
+        else:
+            try:
+                with open(job.targetFileName, 'wb') as f:
+                    f.write(data)
+                self.inventory.refresh(job.fileName)
+                self.stateDatabase.update(job.vID, thumbnailETag = etag)
+            except IOError, e:
+                self.logger.warning("Error saving video thumbnail image: %s", e)
+
+    def getThumbnailSafely(self, job):
+        '''Downloads the video thumbnail image over the pooled session in a thumbnail pool thread, or over the transport if requests is not available.'''
+        started = time()
+        try:
+            if self.thumbnailSession:
+                response = self.thumbnailSession.get(job.link, headers = dict({'User-Agent': job.userAgent}, **({'If-None-Match': str(job.etag)} if job.etag else {})),
+                                                     cookies = dict((str(cookie['name']), str(cookie['value'])) for cookie in job.cookies), timeout = self.timeout)
+                if response.status_code != 304:
+                    response.raise_for_status()
+                self.saveThumbnail(job, response.status_code, response.content, response.headers.get('etag'))
+            else:
+                transfer = self.transport.perform(Transfer('thumbnail', job.link, job.userAgent, cookieHeader(job.cookies), requestHeaders = {'If-None-Match': str(job.etag)} if job.etag else None))
+                if transfer.code != 304:
+                    transfer.check()
+                self.saveThumbnail(job, transfer.code, transfer.body, transfer.headers.get('etag'))
+        except Exception, e:
+            self.setOperation(job.operation)
+            self.logger.warning("Video thumbnail image download failed: %s", e)
+        self.metrics.observe('thumbnail', time() - started)
+
+    def thumbnailTask(self, job):
+        '''Downloads the video thumbnail image as a reactor coroutine.'''
+        started = time()
+        transfer = yield Transfer('thumbnail', job.link, job.userAgent, cookieHeader(job.cookies), requestHeaders = {'If-None-Match': str(job.etag)} if job.etag else None)
+        if transfer.ok or transfer.code == 304 and not transfer.error:
+            self.saveThumbnail(job, transfer.code, transfer.body, transfer.headers.get('etag'))
+        else:
+            self.setOperation(job.operation) # The reactor thread switches between the videos
+            self.logger.warning("Video thumbnail image download failed: %s", transfer.error or "HTTP error %s" % transfer.code)
+        self.metrics.observe('thumbnail', time() - started)
+
+    def downloadVideo(self, job):
+        self.setOperation(job.operation)
+        timeout = self.timeout
+        bandwidth = self.bandwidth
+        segmented = self.segmentSession and job.linkSize and job.linkSize >= 2 * SegmentedDownload.MIN_SEGMENT_SIZE
+        if not segmented and SegmentedDownload.abandon(job.fileName):
+            self.inventory.refresh(job.videoFileName)
+        hasher = ContentHash(job.fileName)
+        startSize = self.inventory.getSize(job.videoFileName) or 0
+        progress = self.progressDisplay.start(job.vID, job.linkSize, startSize)
+        class ProgressIndicator(object):
+            def start(self, *_args, **_kwargs):
+                self.totalRead = 0
+                self.lastData = time()
+
+            def update(self, totalRead):
+                if totalRead <= self.totalRead:
+                    if totalRead and time() > self.lastData + timeout:
+                        raise IOError("Download seems stalled")
+                else:
+                    if bandwidth and self.totalRead: # The first update may include the part resumed from the existing file
+                        bandwidth.consume(totalRead - self.totalRead)
+                    self.totalRead = totalRead
+                    self.lastData = time()
+                    progress.update(totalRead)
+
+            end = update
+
+        self.logger.info("Downloading %d...", job.vID)
+        try:
+            with self.metrics.timer('download'):
+                if segmented:
+                    downloadOK = self.downloadSegmented(job, progress)
+                else:
+                    downloadOK = self.downloadStream(job, ProgressIndicator(), hasher)
+        finally:
+            self.progressDisplay.finish(progress)
+        return self.finishDownload(job, downloadOK, startSize, hasher)
+
+    def finishDownload(self, job, downloadOK, startSize, hasher):
+        '''Checks the downloaded file and saves its state, returns True if the download is OK.'''
+        localSize = self.inventory.refresh(job.videoFileName)[0]
+        self.metrics.count('downloads')
+        self.metrics.count('downloadedBytes', max(0, (localSize or 0) - startSize))
+        if downloadOK:
+            if not localSize:
+                self.error("Downloaded file seems corrupt")
+                downloadOK = False
+            elif job.linkSize:
+                if localSize > job.linkSize:
+                    self.error("Downloaded file larger (%d) than remote file (%d)", localSize, job.linkSize)
+                    downloadOK = False
+                elif localSize < job.linkSize:
+                    self.error("Downloaded file smaller (%d) than remote file (%d)", localSize, job.linkSize)
+                    downloadOK = False
+        digest = sample = None
+        if downloadOK:
+            with self.metrics.timer('hash'):
+                hasher.follow() # Segmented downloads are written out of order, so they are hashed here
+                digest = hasher.hexdigest(localSize)
+                sample = ContentHash.fileSample(job.fileName, localSize) if digest else None
+        hasher.close()
+        if digest and self.deduplicate:
+            duplicate = self.linkDuplicate(job.vID, job.videoFileName, job.fileName, localSize, digest)
+            if duplicate:
+                self.logger.info("Identical to video %d, replaced with a hard link", duplicate[0])
+        if downloadOK:
+            self.saveState(job.vID, job.videoFileName, job.fileName, sha256 = digest, sample = sample, **job.remoteState)
+        if not downloadOK and self.pageCache: # The cached download link may have expired
+            self.pageCache.remove(VIMEO_URL % job.vID)
+        if downloadOK and job.linkSize and self.verifyContent:
+            self.verifyLater(job.vID, job.videoFileName, job.fileName, job.operation)
+        if downloadOK:
+            self.logger.info("Video %d OK", job.vID)
+        return downloadOK
+
+    def downloadStream(self, job, progressIndicator, hasher):
+        '''Downloads the file over the shared transport, every retry continues from the end of the file, which is hashed as it's received.'''
+        downloadOK = False
+        for _ in xrange(self.retryCount):
+            hasher.follow() # The part downloaded before
+            start = hasher.size
+            progressIndicator.start(size = job.linkSize)
+            progressIndicator.update(start)
+            try:
+                transfer = self.transport.perform(Transfer('download', job.link, job.userAgent, cookieHeader(job.cookies), fileName = job.fileName, start = start, hasher = hasher,
+                                                           progress = progressIndicator.update, size = job.linkSize, fsync = self.fsync))
+            except KeyboardInterrupt:
+                self.logger.warning("Download interrupted")
+                continue
+            self.recordWrites(transfer.written, transfer.writeSeconds)
+            if transfer.ok or transfer.code == 416 and not self.getFileSizes: # 416 means the file is complete already
+                progressIndicator.end(getFileSize(job.fileName) or 0)
+                downloadOK = True
+                break
+            self.logger.warning("Download failed: %s", transfer.error or "HTTP error %s" % transfer.code)
+        else:
+            self.error("Download ultimately failed after %d retries", self.retryCount)
+        return downloadOK
+
+    def downloadSegmented(self, job, progress = None):
+        download = SegmentedDownload(self.segmentSession, job.link, job.fileName, job.linkSize, self.segments, self.timeout,
+                                     dict((str(cookie['name']), str(cookie['value'])) for cookie in job.cookies), self.bandwidth, self.fsync, progress, job.userAgent)
+        self.logger.debug("Downloading in %d segments, %s already downloaded", len(download.segments), readableSize(download.downloaded()))
+        started = time()
+        startSize = download.downloaded()
+        try:
+            errors = download.download(self.retryCount)
+        except KeyboardInterrupt:
+            self.logger.warning("Download interrupted")
+            return False
+        finally:
+            self.recordWrites(download.written, download.writeSeconds)
+        for e in errors:
+            self.logger.warning("Segment download failed: %s", e)
+        if errors:
+            self.error("Download ultimately failed after %d retries", self.retryCount)
+            return False
+        self.logger.debug("Downloaded %s at %s/s", readableSize(job.linkSize - startSize), readableSize((job.linkSize - startSize) / max(time() - started, 0.001)))
+        return True
+
+    def downloadTask(self, job):
+        '''Downloads the video file as a reactor coroutine, every retry continues from the end of the file.'''
+        try:
+            self.setOperation(job.operation)
+            self.logger.info("Downloading %d...", job.vID)
+            started = time()
+            if SegmentedDownload.abandon(job.fileName): # Left by a run with --segments, the reactor only streams
+                self.inventory.refresh(job.videoFileName)
+            startSize = self.inventory.getSize(job.videoFileName) or 0
+            downloadOK = False
+            hasher = ContentHash(job.fileName)
+            progress = self.progressDisplay.start(job.vID, job.linkSize, startSize)
+            try:
+                for _ in xrange(self.retryCount):
+                    hasher.follow() # The part downloaded before
+                    maxSpeed = self.reactorMaxSpeed()
+                    transfer = yield Transfer('download', job.link, job.userAgent, cookieHeader(job.cookies), fileName = job.fileName, start = hasher.size, maxSpeed = maxSpeed, hasher = hasher,
+                                              size = job.linkSize, fsync = self.fsync, progress = progress.update)
+                    self.setOperation(job.operation)
+                    self.recordWrites(transfer.written, transfer.writeSeconds)
+                    if transfer.ok or transfer.code == 416 and not self.getFileSizes: # 416 means the file is complete already
+                        downloadOK = True
+                        break
+                    self.logger.warning("Download failed: %s", transfer.error or "HTTP error %s" % transfer.code)
+                else:
+                    self.error("Download ultimately failed after %d retries", self.retryCount)
+            finally:
+                self.progressDisplay.finish(progress)
+            self.metrics.observe('download', time() - started)
+            self.finishDownload(job, downloadOK, startSize, hasher)
+        except Exception, e:
+            self.setOperation(job.operation)
+            self.error(format_exc() if self.verbose else e)
+        finally:
+            self.downloadSlots.release()
+
+    def reactorMaxSpeed(self):
+        '''Returns the speed limit of every reactor download, the bandwidth is shared evenly, as the transfers can't block.'''
+        return self.bandwidth.rate / self.jobs if self.bandwidth else None
+
+    def recordWrites(self, written, seconds):
+        '''Accounts the data written to a downloaded file, the write throughput is logged, so that a slow disk can be told from a slow network.'''
+        if written:
+            self.metrics.count('writtenBytes', written)
+            self.metrics.observe('write', seconds)
+            self.logger.debug("Written %s at %s/s", readableSize(written), readableSize(written / max(seconds, 0.001)))
+
+    def downloadVideoSafely(self, job):
+        try:
+            self.downloadVideo(job)
+        except Exception, e:
+            self.setOperation(job.operation)
+            self.error(format_exc() if self.verbose else e)
 
     def checkForObsoletes(self):
         self.logger.info("Checking for obsolete files...")
-        files = {}
-        folders = set(basename(dirName) for (dirName, _vIDs) in self.folders)
-        for fileName in listdir(unicode(self.targetDirectory)):
-            if not fileName.endswith('.jpg') and not fileName.endswith('.html'):
-                fullName = join(self.targetDirectory, fileName)
-                if '.' in fileName and isfile(fullName):
-                    try:
-                        vID = int(fileName[fileName.rfind(' ') + 1 : fileName.rfind('.')])
-                        files[vID] = files.get(vID, []) + [(fileName, fullName),]
-                    except ValueError:
-                        pass
-                elif self.detectObsolete and isdir(fullName) and not fileName in folders:
-                    self.logger.warning("Unknown folder detected: %s", encodeForConsole(fileName))
-        for (vID, fileNames) in files.iteritems():
-            assert fileNames
-            if self.detectObsolete and vID not in self.vIDs:
-                for (fileName, fullName) in fileNames:
+        if self.detectObsolete:
+            folders = set(basename(dirName) for dirName in self.graph.folders)
+            for dirName in sorted(self.inventory.dirs - folders):
+                self.logger.warning("Unknown folder detected: %s", encodeForConsole(dirName))
+        vIDs = set(self.vIDs) # Only the videos processed in this run
+        for vID in sorted(self.inventory.vIDs):
+            fileNames = tuple(fileName for fileName in self.inventory.getFiles(vID) if not fileName.endswith('.jpg') and not fileName.endswith('.html'))
+            if not fileNames:
+                continue
+            if self.detectObsolete and vID not in vIDs:
+                for fileName in fileNames:
                     self.logger.warning("Unknown vID file detected: %s", encodeForConsole(fileName))
                 continue
             if len(fileNames) == 1:
                 continue
-            for (fileName, fullName) in sorted(fileNames, key = lambda (fileName, fullName): (getsize(fullName), getmtime(fullName)))[:-1]:
+            for fileName in sorted(fileNames, key = self.inventory.get)[:-1]:
                 self.logger.warning("Duplicate vID file detected: %s", encodeForConsole(fileName))
 
-    def run(self):
-        self.loggedIn = False
-        self.userName = None
-        self.folders = []
-        self.totalFileSize = 0
-        try:
-            self.logger.info("Starting %s...", self.driverName)
-            self.driver = self.driverClass() # ToDo: Provide parameters to the driver
+    def processVideoInBrowser(self, (vID, number)):
+        '''Processes the video in the browser session of the current worker thread, restarting the session if it fails.'''
+        for attempt in xrange(self.retryCount + 1):
+            if self.updateFinished.isSet():
+                return
+            try:
+                if not self.driver:
+                    with self.errorsLock:
+                        self.driver = self.spareDrivers.pop() if self.spareDrivers else None
+                    if not self.driver:
+                        self.startDriver()
+                        if self.credentials and not self.login(*self.credentials):
+                            raise WebDriverException("Login failed")
+                if self.pause:
+                    self.logger.debug("Pause %d seconds", self.pause)
+                    sleep(self.pause)
+                if self.completeVideo(self.processVideo(vID, number)) and self.updateOnly:
+                    self.updateFinished.set()
+                return
+            except NoSuchElementException, e:
+                self.error(e.msg)
+                return
+            except WebDriverException, e: # The browser session is broken, restart it and retry the video
+                self.error("Browser session failed (attempt %d): %s", attempt + 1, e.msg)
+                self.closeDriver()
+            except Exception, e:
+                self.error(format_exc() if self.verbose else e)
+                return
+
+    def processVideosInBrowsers(self):
+        '''Shards the videos across the pool of browser sessions, the current session is reused by one of them.'''
+        self.updateFinished = Event()
+        self.spareDrivers = [self.driver]
+        browserPool = WorkerPool(self.processVideoInBrowser, self.browsers, 'Browser', self.browsers)
+        for (n, vID) in enumerate(self.vIDs, 1):
+            if self.updateFinished.isSet():
+                break
+            browserPool.submit((vID, n))
+        browserPool.close()
+        if self.updateFinished.isSet():
+            self.logger.info("Update completed")
+
+    def authorize(self):
+        '''Checks the API token, in place of login() for the api backend, the account of the token is crawled if no start URL is specified.'''
+        self.api = VimeoAPI(self.apiURL, self.apiToken, self.timeout, self.retryCount)
+        user = self.api.get('/me', fields = 'name,link')
+        self.userName = user['name']
+        self.loggedIn = True
+        self.logger.info("Authorized as %s", encodeForConsole(self.userName))
+        if not self.startURL and not self.vIDs:
+            self.startURL = URL(user['link'])
+            self.startURL.createFile(self.targetDirectory)
+
+    def crawl(self):
+        if self.backend == 'api':
+            self.authorize()
+        else:
+            self.startDriver()
             if self.credentials:
                 self.login(*self.credentials)
                 if not self.loggedIn:
                     raise ValueError("Aborting")
-            if not self.vIDs:
+        self.transport = CurlTransport(self.timeout)
+        if self.engine == 'reactor':
+            self.reactor = Reactor(dict(REACTOR_LIMITS, probe = self.probes, download = self.jobs), self.timeout, self.transport.share)
+        if not self.vIDs:
+            if self.backend == 'http':
+                (userAgent, cookies) = self.getBrowserState()
+                if self.reactor:
+                    self.listing = ReactorListing(self.reactor, userAgent, cookies, self.pageCache)
+                else:
+                    self.listing = HTTPListing(self.timeout, self.retryCount, userAgent, cookies, self.pageCache)
+            if self.resume and self.resumeFrontier():
+                self.logger.info("Crawl was complete, got %d videos", len(self.graph))
+            elif self.resume and self.frontier:
+                self.logger.info("Resuming crawl, got %d videos, %d URLs to go", len(self.graph), len(self.frontier))
+                self.walkFrontier()
+            else:
+                if self.resume:
+                    self.logger.warning("Nothing to resume, starting the crawl over")
                 self.getItemsFromURL(self.startURL)
-                if self.folders:
-                    self.logger.info("Got total of %d folders", len(self.folders))
-                self.vIDs = tuple(sorted(self.vIDs, reverse = True))
-            if self.vIDs:
-                assert len(self.vIDs) == len(set(self.vIDs))
-                self.logger.info("Processing %d videos...", len(self.vIDs))
-                if self.getFileSizes:
-                    requests.adapters.DEFAULT_RETRIES = self.retryCount
-                for (n, vID) in enumerate(self.vIDs, 1):
+            self.graphComplete = True
+            if self.graph.folders:
+                self.logger.info("Got total of %d folders", len(self.graph.folders))
+            self.vIDs = tuple(sorted(self.graph.vIDs, reverse = True))
+        if self.vIDs:
+            assert len(self.vIDs) == len(set(self.vIDs))
+            self.logger.info("Processing %d videos...", len(self.vIDs))
+            if self.getFileSizes:
+                self.sizeProber = ReactorProber(self.reactor) if self.reactor else SizeProber(self.probes, self.timeout, self.retryCount)
+            if self.segments > 1 and self.doDownload:
+                self.segmentSession = createSession(self.segments * self.jobs, self.retryCount)
+            if self.saveThumbnails and requests and not self.reactor:
+                self.thumbnailSession = createSession(REACTOR_LIMITS['thumbnail'], self.retryCount)
+                self.thumbnailPool = WorkerPool(self.getThumbnailSafely, REACTOR_LIMITS['thumbnail'], 'Thumbnail')
+            if self.reactor:
+                self.downloadSlots = BoundedSemaphore(2 * self.jobs) # Download links expire, so don't resolve them too far ahead
+            elif self.jobs > 1 and self.doDownload:
+                self.downloadPool = WorkerPool(self.downloadVideoSafely, self.jobs, 'Download', self.jobs) # Download links expire, so don't resolve them too far ahead
+            if self.browsers > 1:
+                self.processVideosInBrowsers()
+                return
+            pending = deque() # Videos processed in the browser, waiting for their size probes
+            for (n, vID) in enumerate(tuple(self.vIDs) + (None,) * self.probes, 1):
+                if vID is not None:
                     if n > 1 and self.pause:
                         self.logger.debug("Pause %d seconds", self.pause)
                         sleep(self.pause)
-                    self.updateCompleted = True
-                    self.processVideo(vID, n)
-                    if self.updateOnly and self.updateCompleted:
+                    pending.append(self.processVideo(vID, n))
+                if len(pending) >= self.probes or vID is None and pending:
+                    if self.completeVideo(pending.popleft()) and self.updateOnly:
                         self.logger.info("Update completed")
                         break
+
+    def saveMetrics(self):
+        report = self.metrics.report()
+        for (phase, stats) in sorted(report['phases'].iteritems(), key = lambda (phase, stats): -stats['sum']):
+            self.logger.info("Time spent in %s: %s in %d operations, max %.1fs", phase, readableTime(stats['sum']), stats['count'], stats['max'])
+        written = report['counters'].get('writtenBytes')
+        if written:
+            self.logger.info("Written %s to the disk at %s/s", readableSize(written), readableSize(written / max(report['phases']['write']['sum'], 0.001)))
+        try:
+            if self.metricsFileName:
+                self.metrics.writeReport(self.metricsFileName)
+            if self.prometheusFileName:
+                self.metrics.writeTextFile()
+        except (IOError, OSError), e:
+            self.error("Error saving metrics: %s", e)
+
+    def watchLimits(self):
+        '''Applies the limits from the limits file every time it's changed during the run.'''
+        fileName = join(self.targetDirectory, LIMITS_FILE_NAME)
+        try:
+            lastMTime = stat(fileName).st_mtime # The file left from a previous run doesn't override the options
+        except OSError:
+            lastMTime = None
+        while not self.limitsClosed.wait(LIMITS_CHECK_INTERVAL):
+            try:
+                mtime = stat(fileName).st_mtime
+            except OSError:
+                continue
+            if mtime != lastMTime:
+                lastMTime = mtime
+                self.applyLimits(fileName)
+
+    def applyLimits(self, fileName):
+        '''Reads lines like "rate-limit 2M" or "page-rate off" from the limits file, and changes the limits accordingly.'''
+        try:
+            with open(fileName) as f:
+                lines = f.read().splitlines()
+        except IOError, e:
+            self.logger.warning("Error reading limits file: %s", e)
+            return
+        for line in lines:
+            tokens = line.split('#')[0].split()
+            if not tokens:
+                continue
+            try:
+                if len(tokens) != 2:
+                    raise ValueError
+                (name, value) = (tokens[0].lower(), None if tokens[1].lower() == 'off' else tokens[1])
+                if name == 'rate-limit':
+                    rate = parseSize(value) if value else None
+                    if rate is not None and rate <= 0:
+                        raise ValueError
+                    if not rate:
+                        self.bandwidth = None # The downloads already running keep the previous limit
+                    elif self.bandwidth:
+                        self.bandwidth.setRate(rate, rate)
+                    else:
+                        self.bandwidth = TokenBucket(rate)
+                    if self.reactor:
+                        self.reactor.setMaxSpeed('download', self.reactorMaxSpeed())
+                    self.logger.info("Download rate limit %s", ('set to %s/s' % readableSize(rate)) if rate else 'removed')
+                elif name == 'page-rate':
+                    rate = float(value) if value else None
+                    if rate is not None and rate <= 0:
+                        raise ValueError
+                    self.pacer.setMaxRate(rate)
+                    self.logger.info("Page rate limit %s", ('set to %g pages per minute' % rate) if rate else 'removed')
+                else:
+                    self.logger.warning("Unknown limit in limits file: %s", line.strip())
+            except (ValueError, ZeroDivisionError):
+                self.logger.warning("Bad line in limits file, expected rate-limit or page-rate and a positive value or off: %s", line.strip())
+
+    def run(self):
+        self.loggedIn = False
+        self.userName = None
+        self.totalFileSize = 0
+        self.limitsClosed = Event()
+        self.limitsWatcher = Thread(target = self.watchLimits, name = 'Limits')
+        self.limitsWatcher.daemon = True
+        self.limitsWatcher.start()
+        try:
+            if self.verifyContent or self.verifyExisting:
+                self.verifyPool = WorkerPool(self.verifyVideoSafely, cpu_count(), 'Verify')
+            if self.verifyOnly:
+                self.verifyArchive()
+            else:
+                self.crawl()
         except Exception, e:
             self.error(format_exc() if self.verbose else e)
         finally:
-            if self.driver:
-                self.driver.close()
+            self.limitsClosed.set()
+            while self.limitsWatcher.isAlive():
+                self.limitsWatcher.join(1) # Timeout keeps the main thread responsive to KeyboardInterrupt
+            for driver in tuple(self.drivers):
+                try:
+                    driver.quit()
+                except Exception, e:
+                    self.logger.warning("Error closing browser session: %s", e)
+            if self.sizeProber:
+                self.sizeProber.close()
+            if self.thumbnailPool:
+                self.thumbnailPool.close()
+            if self.downloadPool:
+                self.setOperation(None)
+                self.logger.info("Waiting for downloads to complete...")
+                self.downloadPool.close()
+            if self.reactor:
+                self.setOperation(None)
+                self.logger.info("Waiting for transfers to complete...")
+                self.reactor.close()
+            if self.transport:
+                self.transport.close()
+            self.progressDisplay.close()
+            if self.verifyPool:
+                self.setOperation(None)
+                self.logger.info("Waiting for verification to complete...")
+                self.verifyPool.close()
+            if self.graph.folders:
+                self.setOperation(None)
+                self.reconcileLinks()
+            self.stateDatabase.close()
+            self.journal.close()
+            if self.pageCache:
+                self.pageCache.close()
+                if self.pageCache.hitRate() is not None:
+                    stats = self.pageCache.stats
+                    self.logger.info("Page cache hit rate %d%%: %d hits, %d revalidated, %d expired, %d misses",
+                                     self.pageCache.hitRate() * 100, stats['hits'], stats['revalidated'], stats['expired'], stats['misses'])
+            self.saveMetrics()
         self.logger.info("Crawling completed" + (' with %d errors' % self.errors if self.errors else ''))
         self.errorHandler.close()
         getLogger().removeHandler(self.errorHandler)